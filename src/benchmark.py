@@ -0,0 +1,87 @@
+import os
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+import argparse
+import itertools
+import time
+import yaml
+import numpy as np
+from util import load_hparams, load_hparams_overlay, run_isolated, peak_rss_mb
+
+def measure_train_step(hparams, steps):
+    """
+    Runs steps transformer training steps on random tokens and returns the
+    duration of the first step, which includes tracing and compiling, the
+    median step time in seconds and the peak RSS in MB. Meant to be run
+    through run_isolated, so that the peak RSS is that of this setting only,
+    and the devices of the distribution strategy can be set up.
+    """
+    import tensorflow as tf
+    from models.common.precision import set_precision_policy
+    from models.common.distribute import create_strategy
+    from models.common.training import create_train_step
+    from models.transformer.train import create_model, input_vocab_size
+
+    strategy = create_strategy(hparams)
+    set_precision_policy(hparams)
+    with strategy.scope():
+        transformer = create_model(hparams)
+        train_step = create_train_step(transformer, hparams)
+
+        shape = [hparams['batch_size'], hparams['frame_size']]
+        batch = (tf.random.uniform(shape, 1, input_vocab_size, dtype=tf.int64),
+                 tf.random.uniform(shape, 1, input_vocab_size, dtype=tf.int64))
+        # Split over the replicas, like the batches of the trainer
+        batch = next(iter(strategy.experimental_distribute_dataset(tf.data.Dataset.from_tensors(batch))))
+
+        # The first step includes tracing the train step
+        start = time.time()
+        train_step(batch)['loss'].numpy()
+        first_step_time = time.time() - start
+
+        durations = []
+        for _ in range(steps):
+            start = time.time()
+            loss = train_step(batch)['loss']
+            loss.numpy()
+            durations.append(time.time() - start)
+
+    return first_step_time, float(np.median(durations)), peak_rss_mb()
+
+def parse_settings(settings):
+    """
+    Parses the --set arguments, like 'remat=false,true', into a list of
+    every combination of the given values.
+    """
+    options = []
+    for setting in settings:
+        key, values = setting.split('=')
+        options.append([(key, yaml.safe_load(value)) for value in values.split(',')])
+    return [dict(combination) for combination in itertools.product(*options)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure step time and peak memory of transformer training')
+
+    parser.add_argument('--set', metavar='KEY=VALUES', help='An hparam and a comma separated list of values to measure, can be repeated', type=str, action='append', default=[])
+    parser.add_argument('--steps', metavar='N', help='Number of steps to measure each setting', type=int, default=10)
+
+    args = parser.parse_args()
+
+    hparams = load_hparams('hparams/transformer.yml')
+    hparams = load_hparams_overlay('hparams/transformer.tuned.yml', hparams)
+
+    results = []
+    for settings in parse_settings(args.set):
+        print(f"Measuring {settings}...")
+        try:
+            first_step_time, step_time, rss = run_isolated(measure_train_step, { **hparams, **settings }, args.steps)
+        except Exception as e:
+            # Typically running out of memory
+            print(f"Failed: {e}")
+            first_step_time, step_time, rss = float('nan'), float('nan'), float('nan')
+        results.append((settings, first_step_time, step_time, rss))
+
+    print()
+    print(f"{'First step (s)':>14} {'Step time (s)':>14} {'Examples/s':>14} {'Peak RSS (MB)':>14}  Settings")
+    for settings, first_step_time, step_time, rss in results:
+        batch_size = settings['batch_size'] if 'batch_size' in settings else hparams['batch_size']
+        print(f"{first_step_time:14.3f} {step_time:14.3f} {batch_size / step_time:14.1f} {rss:14.0f}  {settings}")
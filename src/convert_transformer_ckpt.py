@@ -0,0 +1,92 @@
+import os
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+import argparse
+import numpy as np
+import tensorflow as tf
+from models.transformer.model import create_transformer
+from models.transformer.train import input_vocab_size, target_vocab_size
+from util import load_hparams, load_hparams_overlay
+
+# Converts transformer checkpoints from before the fused attention
+# projections, where every attention block had separate wq, wk, wv and dense
+# layers, to the qkv/output kernels of FusedAttention. Everything else is
+# carried over as is, except the optimizer slots of the attention weights,
+# which start over.
+
+def attention_blocks(transformer):
+    """
+    The attention blocks of transformer by their path in the checkpoint.
+    """
+    blocks = {}
+    if hasattr(transformer, 'encoder'):
+        for i, layer in enumerate(transformer.encoder.layers):
+            blocks[f'encoder/layers/{i}/rga'] = layer.rga
+    for i, layer in enumerate(transformer.decoder.layers):
+        if hasattr(layer, 'rga1'):
+            blocks[f'decoder/layers/{i}/rga1'] = layer.rga1
+            blocks[f'decoder/layers/{i}/rga2'] = layer.rga2
+        else:
+            blocks[f'decoder/layers/{i}/rga'] = layer.rga
+    return blocks
+
+def fuse_attention(reader, path, attention):
+    def get(name):
+        return reader.get_tensor(f'{path}/{name}/.ATTRIBUTES/VARIABLE_VALUE')
+
+    heads, depth = attention.num_heads, attention.depth
+
+    # The Dense outputs were split into heads as [heads, depth]
+    kernel = np.stack([get(f'{w}/kernel') for w in ['wq', 'wk', 'wv']], axis=1)
+    bias = np.stack([get(f'{w}/bias') for w in ['wq', 'wk', 'wv']])
+
+    attention.qkv_kernel.assign(kernel.reshape([-1, 3, heads, depth]))
+    attention.qkv_bias.assign(bias.reshape([3, heads, depth]))
+    attention.output_kernel.assign(get('dense/kernel').reshape([heads, depth, -1]))
+    attention.output_bias.assign(get('dense/bias'))
+
+def convert(hparams, old_dir, new_dir):
+    transformer = create_transformer(input_vocab_size=input_vocab_size,
+                                     target_vocab_size=target_vocab_size,
+                                     pe_input=input_vocab_size,
+                                     pe_target=target_vocab_size,
+                                     hparams=hparams)
+
+    # Create the variables and optimizer slots so that the restore below
+    # fills them right away. The zero update is overwritten by the restore,
+    # except for the slots of the new attention weights, which stay 0.
+    transformer.create_weights()
+    variables = transformer.trainable_variables
+    transformer.optimizer.apply_gradients(zip([tf.zeros_like(v) for v in variables], variables))
+
+    step = tf.Variable(0)
+    ckpt = tf.train.Checkpoint(
+        step=step,
+        transformer=transformer,
+        optimizer=transformer.optimizer
+    )
+
+    old_ckpt = tf.train.latest_checkpoint(old_dir)
+    assert old_ckpt is not None, f"No checkpoint in {old_dir}"
+    ckpt.restore(old_ckpt).expect_partial()
+
+    reader = tf.train.load_checkpoint(old_ckpt)
+    for path, attention in attention_blocks(transformer).items():
+        fuse_attention(reader, f'transformer/{path}', attention)
+
+    manager = tf.train.CheckpointManager(ckpt, new_dir, max_to_keep=3)
+    return manager.save(checkpoint_number=step)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a transformer checkpoint to the fused attention layout')
+
+    parser.add_argument('--hparams', metavar='PATH', help='The hparams the checkpoint was trained with', type=str, default='hparams/transformer.yml')
+    parser.add_argument('--from', metavar='DIR', dest='old_dir', help='The checkpoint directory to convert, by default the one train.py uses', type=str, default=None)
+    parser.add_argument('--to', metavar='DIR', dest='new_dir', required=True, help='Where to save the converted checkpoint', type=str)
+
+    args = parser.parse_args()
+
+    hparams = load_hparams(args.hparams)
+    hparams = load_hparams_overlay(args.hparams.replace('.yml', '.tuned.yml'), hparams)
+
+    old_dir = args.old_dir or os.path.join(hparams['save_dir'], 'ckpts', hparams['name'])
+    print(f"Saved {convert(hparams, old_dir, args.new_dir)}")
@@ -0,0 +1,106 @@
+import os
+import json
+import numpy as np
+import tensorflow as tf
+import data.process as pro
+
+# Storage formats for the spectrograms. The spectrograms are expected to be
+# normalized to [-1, 1] (nsynth_to_melspec with stats), which is what makes
+# the 8-bit format possible.
+store_dtypes = {
+    'float32': np.float32,
+    'float16': np.float16,
+    'uint8': np.uint8,
+}
+
+def _quantize(x, dtype):
+    if dtype == 'uint8':
+        return np.round((np.clip(x, -1, 1) + 1) * 127.5).astype(np.uint8)
+    return x.astype(store_dtypes[dtype])
+
+def _dequantize(x, dtype):
+    if dtype == 'uint8':
+        return tf.cast(x, tf.float32) / 127.5 - 1
+    return tf.cast(x, tf.float32)
+
+def melspec_store_exists(path):
+    return os.path.exists(os.path.join(path, 'meta.json'))
+
+def build_melspec_store(dataset, path, stats=None, dtype='float16', write_size=256):
+    """
+    Writes a dataset of normalized melspectrograms, as produced by
+    nsynth_to_melspec, to a memory mappable store at path. The spectrograms
+    are stored as dtype (see store_dtypes) and the one-hot pitches as pitch
+    indices. The stats used for the normalization are saved next to them so
+    that generation can denormalize with the same values.
+    """
+    if dtype not in store_dtypes:
+        raise Exception(f"No store dtype named '{dtype}'.")
+
+    os.makedirs(path, exist_ok=True)
+    audio_path = os.path.join(path, 'audio.bin')
+    pitch_path = os.path.join(path, 'pitch.bin')
+
+    print(f"Building melspec store in {path}...")
+    count = 0
+    shape = None
+    with open(audio_path + '.tmp', 'wb') as audio_file, open(pitch_path + '.tmp', 'wb') as pitch_file:
+        for x in dataset.batch(write_size).as_numpy_iterator():
+            shape = x['audio'].shape[1:]
+            audio_file.write(_quantize(x['audio'], dtype).tobytes())
+            pitch_file.write(np.argmax(x['pitch'], axis=-1).astype(np.int16).tobytes())
+            count += x['audio'].shape[0]
+
+    assert shape is not None, "Can not build a melspec store from an empty dataset"
+
+    os.replace(audio_path + '.tmp', audio_path)
+    os.replace(pitch_path + '.tmp', pitch_path)
+    if stats is not None:
+        np.savez(os.path.join(path, 'stats.npz'), **stats)
+
+    # The meta file is written last, its presence marks a complete store
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'count': count, 'shape': list(shape), 'dtype': dtype}, f)
+    print(f"Building melspec store done, {count} spectrograms.")
+
+def load_melspec_store_stats(path):
+    return np.load(os.path.join(path, 'stats.npz'))
+
+def melspec_store(path, cond_vector_size, shuffle=True, read_size=256):
+    """
+    Creates a dataset reading the spectrograms of a store written by
+    build_melspec_store. The elements have the same structure as the ones
+    from nsynth_to_melspec. The store is memory mapped and read read_size
+    spectrograms at a time; shuffling is done on the indices, so it covers the
+    whole store without a shuffle buffer.
+    """
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    count, shape, dtype = meta['count'], meta['shape'], meta['dtype']
+
+    audio = np.memmap(os.path.join(path, 'audio.bin'), dtype=store_dtypes[dtype], mode='r', shape=(count, *shape))
+    pitch = np.memmap(os.path.join(path, 'pitch.bin'), dtype=np.int16, mode='r', shape=(count,))
+
+    def _read(indices):
+        # Reading in index order keeps the memory mapped reads sequential,
+        # the spectrograms are put back in the shuffled order after
+        indices = indices.numpy()
+        order = np.argsort(indices)
+        restore = np.argsort(order)
+        return audio[indices[order]][restore], pitch[indices[order]][restore]
+
+    def _decode(indices):
+        a, p = tf.py_function(_read, [indices], [tf.as_dtype(store_dtypes[dtype]), tf.int16])
+        a = tf.reshape(_dequantize(a, dtype), [-1, *shape])
+        p = tf.one_hot(tf.cast(tf.reshape(p, [-1]), tf.int32), cond_vector_size)
+        return {'audio': a, 'pitch': p}
+
+    dataset = tf.data.Dataset.range(count)
+    if shuffle:
+        dataset = dataset.shuffle(count)
+
+    return pro.pipeline([
+        pro.batch(read_size),
+        pro.map_transform(_decode),
+        pro.unbatch(),
+    ])(dataset)
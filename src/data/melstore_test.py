@@ -0,0 +1,39 @@
+import unittest
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+from data.melstore import build_melspec_store, melspec_store
+
+class TestMelspecStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # Every spectrogram is filled with its index, to tell them apart
+        self.audio = np.repeat(np.linspace(-1, 1, 32), 4 * 3).reshape([32, 4, 3]).astype(np.float32)
+        self.pitch = np.eye(8, dtype=np.float32)[np.arange(32) % 8]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self, dtype, shuffle):
+        dataset = tf.data.Dataset.from_tensor_slices({'audio': self.audio, 'pitch': self.pitch})
+        build_melspec_store(dataset, self.path, dtype=dtype, write_size=5)
+        return list(melspec_store(self.path, 8, shuffle=shuffle, read_size=16).as_numpy_iterator())
+
+    def test_read(self):
+        for dtype, tolerance in [('float32', 0), ('float16', 1e-3), ('uint8', 1 / 127.5)]:
+            with self.subTest(dtype=dtype):
+                examples = self.read(dtype, False)
+                np.testing.assert_allclose([x['audio'] for x in examples], self.audio, atol=tolerance)
+                np.testing.assert_array_equal([x['pitch'] for x in examples], self.pitch)
+
+    def test_shuffle(self):
+        examples = self.read('float32', True)
+        indices = [int(np.argmin(np.abs(self.audio[:, 0, 0] - x['audio'][0, 0]))) for x in examples]
+        self.assertEqual(sorted(indices), list(range(32)))
+        # The chunks are read in index order but keep the shuffled order
+        self.assertNotEqual(indices[:16], sorted(indices[:16]))
+        for i, x in zip(indices, examples):
+            np.testing.assert_array_equal(x['audio'], self.audio[i])
+            np.testing.assert_array_equal(x['pitch'], self.pitch[i])
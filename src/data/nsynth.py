@@ -1,23 +1,78 @@
 import tensorflow as tf
 import data.process as pro
 
-def nsynth_from_tfrecord(nsynth_tfrecord_path):
+# Lowest pitch present in the NSynth subsets we train on, pitch labels are
+# offset by this before being one-hot encoded.
+min_pitch = 24
+
+nsynth_metadata_features = {
+    "note_str": tf.io.FixedLenFeature([], dtype=tf.string),
+    "pitch": tf.io.FixedLenFeature([1], dtype=tf.int64),
+    "velocity": tf.io.FixedLenFeature([1], dtype=tf.int64),
+    "qualities": tf.io.FixedLenFeature([10], dtype=tf.int64),
+    "instrument_source": tf.io.FixedLenFeature([1], dtype=tf.int64),
+    "instrument_family": tf.io.FixedLenFeature([1], dtype=tf.int64),
+}
+
+nsynth_features = {
+    **nsynth_metadata_features,
+    "audio": tf.io.FixedLenFeature([64000], dtype=tf.float32),
+}
+
+def nsynth_from_tfrecord(nsynth_tfrecord_path, hparams=None, batch_size=None, unbatched=True):
+    """
+    Reads an NSynth TFRecord file. If hparams are given, the records are
+    filtered with nsynth_predicate(hparams) on their metadata before the audio
+    feature is parsed, so rejected records never have their audio decoded.
+
+    If batch_size is given, the serialized records are parsed batch_size at a
+    time with parse_example instead of one by one. The batches are split up
+    again unless unbatched is False, in which case the (filtered) batches can
+    be smaller than batch_size.
+    """
     dataset = tf.data.TFRecordDataset([nsynth_tfrecord_path])
+    predicate = nsynth_predicate(hparams) if hparams is not None else None
+
+    if batch_size is not None:
+        return _nsynth_parse_batched(dataset, predicate, batch_size, unbatched)
+
+    if predicate is None:
+        return pro.parse_tfrecord(nsynth_features)(dataset)
+
     return pro.pipeline([
-        pro.parse_tfrecord({
-            "note_str": tf.io.FixedLenFeature([], dtype=tf.string),
-            "pitch": tf.io.FixedLenFeature([1], dtype=tf.int64),
-            "velocity": tf.io.FixedLenFeature([1], dtype=tf.int64),
-            "audio": tf.io.FixedLenFeature([64000], dtype=tf.float32),
-            "qualities": tf.io.FixedLenFeature([10], dtype=tf.int64),
-            "instrument_source": tf.io.FixedLenFeature([1], dtype=tf.int64),
-            "instrument_family": tf.io.FixedLenFeature([1], dtype=tf.int64),
-        }),
+        pro.map_transform(lambda x: (x, tf.io.parse_single_example(x, nsynth_metadata_features))),
+        pro.filter(lambda x, metadata: tf.reshape(predicate(metadata), [])),
+        pro.map_transform(lambda x, metadata: x),
+        pro.parse_tfrecord(nsynth_features),
     ])(dataset)
 
+def _nsynth_parse_batched(dataset, predicate, batch_size, unbatched):
+    if predicate is None:
+        return pro.parse_tfrecord_batch(nsynth_features, batch_size, unbatched)(dataset)
+
+    def _parse(x):
+        metadata = tf.io.parse_example(x, nsynth_metadata_features)
+        keep = tf.reshape(predicate(metadata), [-1])
+        return tf.io.parse_example(tf.boolean_mask(x, keep), nsynth_features)
+
+    dataset = pro.pipeline([
+        pro.batch(batch_size),
+        pro.map_transform(_parse),
+    ])(dataset)
+
+    if unbatched:
+        return pro.unbatch()(dataset)
+    return pro.filter(lambda x: tf.shape(x['pitch'])[0] > 0)(dataset)
+
+def _instrument(x, key):
+    # tfds nests the instrument metadata, the raw TFRecords do not
+    if 'instrument' in x:
+        return x['instrument'][key]
+    return x[f'instrument_{key}']
+
 def instrument_filter(key, value, value_map):
     def _filter(x):
-        return tf.reshape(tf.math.equal(x['instrument'][key], value_map[value]), [])
+        return tf.math.equal(_instrument(x, key), value_map[value])
     return _filter
 
 def instrument_sources_filter(value):
@@ -26,16 +81,48 @@ def instrument_sources_filter(value):
 def instrument_families_filter(value):
     return instrument_filter('family', value, instrument_families)
 
-def nsynth_to_melspec(dataset, hparams, stats=None):
+def pitch_filter(cond_vector_size):
+    def _filter(x):
+        pitch = x['pitch'] - min_pitch
+        return tf.math.logical_and(pitch >= 0, pitch < cond_vector_size)
+    return _filter
+
+def nsynth_predicate(hparams):
+    """
+    Combines the instrument and pitch filters selected by hparams into a
+    single predicate that only looks at metadata features. The predicate is
+    elementwise, so it keeps the shape of the features it is given. Returns
+    None when nothing should be filtered.
+    """
+    filters = []
     if 'instrument' in hparams and hparams['instrument'] is not None:
         instrument = hparams['instrument']
         if 'family' in instrument and instrument['family'] is not None:
-            dataset = pro.filter(instrument_families_filter(instrument['family']))(dataset)
-        if 'source' in hparams and hparams['source'] is not None:
-            dataset = pro.filter(instrument_sources_filter(instrument['source']))(dataset)
+            filters.append(instrument_families_filter(instrument['family']))
+        if 'source' in instrument and instrument['source'] is not None:
+            filters.append(instrument_sources_filter(instrument['source']))
+    if 'cond_vector_size' in hparams:
+        filters.append(pitch_filter(hparams['cond_vector_size']))
+
+    if not filters:
+        return None
+
+    def _predicate(x):
+        keep = filters[0](x)
+        for f in filters[1:]:
+            keep = tf.math.logical_and(keep, f(x))
+        return keep
+    return _predicate
+
+def nsynth_to_melspec(dataset, hparams, stats=None):
+    # Filter on metadata before any of the audio is touched, so rejected
+    # records never reach the melspectrogram computation
+    predicate = nsynth_predicate(hparams)
+    if predicate is not None:
+        dataset = pro.filter(lambda x: tf.reshape(predicate(x), []))(dataset)
 
     dataset = pro.index_map('pitch', pro.pipeline([
-        pro.map_transform(lambda x: x - 24),
+        pro.map_transform(lambda x: x - min_pitch),
         pro.one_hot(hparams['cond_vector_size']),
         pro.map_transform(lambda x: tf.cast(x, tf.float32)),
     ]))(dataset)
@@ -3,6 +3,17 @@ import librosa
 from fractions import Fraction
 import data.midi
 
+# Parallelism used by map_transform on tf.data datasets, see set_num_parallel_calls
+num_parallel_calls = tf.data.experimental.AUTOTUNE
+
+def set_num_parallel_calls(n):
+    """
+    Sets the num_parallel_calls used by all map transforms created after this
+    call. Pass tf.data.experimental.AUTOTUNE (-1) to let tf.data decide.
+    """
+    global num_parallel_calls
+    num_parallel_calls = n
+
 def index_map(index, f):
     # Carl: I don't think this parallelizes very well, but I'm not sure
     def imap(x):
@@ -20,7 +31,7 @@ def pipeline(transforms):
 def map_transform(fn):
     def transform(dataset):
         if isinstance(dataset, tf.data.Dataset):
-            return dataset.map(fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            return dataset.map(fn, num_parallel_calls=num_parallel_calls)
         elif not isinstance(dataset, tf.Tensor):
             return map(fn, dataset)
         else:
@@ -61,6 +72,19 @@ def filter_transform(fn):
 def parse_tfrecord(features):
     return map_transform(lambda x: tf.io.parse_single_example(x, features))
 
+def parse_tfrecord_batch(features, batch_size, unbatched=True):
+    """
+    Like parse_tfrecord, but batches the serialized records first and parses
+    a whole batch with a single parse_example call. If unbatched is True the
+    parsed batches are split up again, so the elements look the same as with
+    parse_tfrecord.
+    """
+    return pipeline([
+        batch(batch_size),
+        map_transform(lambda x: tf.io.parse_example(x, features)),
+        *([unbatch()] if unbatched else []),
+    ])
+
 def resample(orig_sr, target_sr, dtype=None):
     return map_transform(lambda x: tf.reshape(tf.py_function(lambda x: librosa.core.resample(x.numpy(), orig_sr=orig_sr, target_sr=target_sr), [tf.reshape(x, [-1])], x.dtype if dtype is None else dtype), [-1]))
 
@@ -96,6 +120,15 @@ def reshape(shape):
 def cache(filename=''):
     return lambda dataset: dataset.cache(filename)
 
+def cache_placement(placement='memory'):
+    """
+    Caches in memory for 'memory', does nothing for 'none' and caches to the
+    file at placement otherwise.
+    """
+    if placement == 'none':
+        return lambda dataset: dataset
+    return cache('' if placement == 'memory' else placement)
+
 def batch(batch_size, drop_remainder=False):
     return lambda dataset: dataset.batch(batch_size, drop_remainder)
 
@@ -105,8 +138,18 @@ def unbatch():
 def shuffle(buffer_size):
     return lambda dataset: dataset.shuffle(buffer_size)
 
-def prefetch():
-    return lambda dataset: dataset.prefetch(tf.data.experimental.AUTOTUNE)
+def prefetch(buffer_size=tf.data.experimental.AUTOTUNE):
+    return lambda dataset: dataset.prefetch(buffer_size)
+
+def interleave(transform, cycle_length=tf.data.experimental.AUTOTUNE):
+    """
+    Applies transform to every element of the dataset on its own, e.g. one
+    file at a time, and interleaves the resulting datasets, reading from
+    cycle_length of them at once.
+    """
+    return lambda dataset: dataset.interleave(lambda x: transform(tf.data.Dataset.from_tensors(x)),
+                                              cycle_length=cycle_length,
+                                              num_parallel_calls=num_parallel_calls)
 
 def pad(paddings, mode, constant_values=0, name=None):
     return map_transform(_pad(paddings, mode, constant_values, name))
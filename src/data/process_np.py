@@ -0,0 +1,80 @@
+import numpy as np
+import librosa
+
+#
+# NumPy versions of the transforms in data.process, for use outside of
+# tf.data (e.g. post-processing generated samples). Every transform works on
+# a whole batch at once, the first axis being the batch axis, and constants
+# are computed when the transform is created rather than on every call.
+#
+
+def pipeline(transforms):
+    def transform(x):
+        for trns in transforms:
+            x = trns(x)
+        return x
+    return transform
+
+def reshape(shape):
+    return lambda x: np.reshape(x, shape)
+
+def normalize(normalization='neg_one_to_one', **kwargs):
+    if normalization == 'specgan':
+        stats = kwargs['stats']
+        mean = np.asarray(stats['mean'])
+        scale = 3 * np.sqrt(np.asarray(stats['variance']))
+        return lambda x: np.clip((x - mean) / scale, -1, 1)
+
+    def _n(x):
+        # Like data.process.normalize, the min and max are per example
+        axes = tuple(range(1, np.ndim(x)))
+        _min = np.min(x, axis=axes, keepdims=True)
+        _max = np.max(x, axis=axes, keepdims=True)
+        if normalization == 'neg_one_to_one':
+            return ((x - _min) / (_max - _min)) * 2 - 1
+        elif normalization == 'zero_to_one':
+            return (x - _min) / (_max - _min)
+        else:
+            raise Exception(f"No normalization type named '{normalization}'.")
+    return _n
+
+def denormalize(normalization='neg_one_to_one', **kwargs):
+    if normalization == 'neg_one_to_one':
+        amin, amax = kwargs['denorm_amin'], kwargs['denorm_amax']
+        return lambda x: ((x + 1) * 0.5) * (amax - amin) + amin
+    elif normalization == 'zero_to_one':
+        amin, amax = kwargs['denorm_amin'], kwargs['denorm_amax']
+        return lambda x: x * (amax - amin) + amin
+    elif normalization == 'specgan':
+        stats = kwargs['stats']
+        mean = np.asarray(stats['mean'])
+        scale = 3 * np.sqrt(np.asarray(stats['variance']))
+        return lambda x: x * scale + mean
+    else:
+        raise Exception(f"No normalization type named '{normalization}'.")
+
+def db_to_power(ref=1.0):
+    return lambda x: ref * np.power(10.0, 0.1 * x)
+
+def mel_to_stft(sr, n_fft=1024, power=2.0):
+    def _m(x):
+        # The least squares inversion is independent per frame, so the whole
+        # batch is inverted at once by laying the spectrograms out along time.
+        batch, n_mels, frames = x.shape
+        x = np.transpose(x, [1, 0, 2]).reshape([n_mels, batch * frames])
+        s = librosa.feature.inverse.mel_to_stft(x, sr=sr, n_fft=n_fft, power=power)
+        return np.transpose(s.reshape([s.shape[0], batch, frames]), [1, 0, 2])
+    return _m
+
+def griffinlim(hop_length=512, win_length=None, n_iter=32):
+    # Phase reconstruction runs along time, so this has to go one example
+    # at a time
+    return lambda x: np.stack([librosa.griffinlim(s, n_iter=n_iter, hop_length=hop_length, win_length=win_length)
+                               for s in x])
+
+def invert_log_melspec(sr, n_fft=1024, hop_length=512, win_length=None):
+    return pipeline([
+        db_to_power(ref=1.0),
+        mel_to_stft(sr, n_fft),
+        griffinlim(hop_length, win_length),
+    ])
@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+import librosa
+import data.process_np as pnp
+
+class TestProcessNp(unittest.TestCase):
+
+    def test_specgan_roundtrip(self):
+        stats = {
+            'mean': np.random.uniform(-40, 0, [8, 6]),
+            'variance': np.random.uniform(1, 10, [8, 6]),
+        }
+        x = np.random.uniform(-1, 1, [4, 8, 6])
+        y = pnp.pipeline([
+            pnp.denormalize(normalization='specgan', stats=stats),
+            pnp.normalize(normalization='specgan', stats=stats),
+        ])(x)
+        np.testing.assert_allclose(x, y)
+
+    def test_normalize_per_example(self):
+        x = np.stack([np.linspace(0, 1, 10), np.linspace(-5, 5, 10)])
+        y = pnp.normalize()(x)
+        np.testing.assert_allclose(y.min(axis=1), [-1, -1])
+        np.testing.assert_allclose(y.max(axis=1), [1, 1])
+
+    def test_db_to_power(self):
+        x = np.random.uniform(-80, 0, [3, 5, 7])
+        np.testing.assert_allclose(pnp.db_to_power()(x), librosa.core.db_to_power(x, ref=1.0))
+
+    def test_mel_to_stft_batch(self):
+        sr, n_fft = 16000, 1024
+        mels = np.random.uniform(0, 1, [3, 128, 5]).astype(np.float32)
+        stft = pnp.mel_to_stft(sr, n_fft)(mels)
+        self.assertEqual(stft.shape, (3, n_fft//2+1, 5))
+        for x, s in zip(mels, stft):
+            np.testing.assert_allclose(s, librosa.feature.inverse.mel_to_stft(x, sr=sr, n_fft=n_fft), atol=1e-4)
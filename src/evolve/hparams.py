@@ -13,11 +13,14 @@ class HParams():
         for key in self.template:
             if type(self.template[key]) == dict:
                 type_ = self.template[key]['type']
-                if type_ == 'range':
-                    new_val = gen_range(self.template[key]['min'],
-                                        self.template[key]['max'],
-                                        self.template[key]['step']
-                                                    if 'step' in self.template[key] else 1)
+                if type_ in ('range', 'choice'):
+                    if type_ == 'range':
+                        new_val = gen_range(self.template[key]['min'],
+                                            self.template[key]['max'],
+                                            self.template[key]['step']
+                                                        if 'step' in self.template[key] else 1)
+                    else:
+                        new_val = random.choice(self.template[key]['values'])
                     if old is not None:
                         old_val = old[key]
                         if random.random() < mutation_rate:
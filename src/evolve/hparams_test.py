@@ -20,3 +20,16 @@ class TestHParams(unittest.TestCase):
         self.assertIsInstance(hparams['int_range_test'], int)
         self.assertIsInstance(hparams['float_range_test'], float)
 
+    def test_generate_choice(self):
+        values = [1, 'memory', None]
+        template = {
+            'choice_test': {
+                'type': 'choice',
+                'values': values,
+            },
+        }
+        hparams = HParams(template).generate()
+        self.assertIn(hparams['choice_test'], values)
+
+        mutated = HParams(template).generate(mutation_rate=0, old=hparams)
+        self.assertEqual(mutated['choice_test'], hparams['choice_test'])
@@ -16,6 +16,7 @@ import models.transformer.generate as transformer
 from models.common.training import Trainer
 from models.gan.model import GAN
 import data.process as pro
+import data.process_np as pnp
 import data.midi as M
 
 transformer_hparams = util.load_hparams('hparams/transformer.yml')
@@ -49,19 +50,19 @@ gan_ckpt = tf.train.Checkpoint(
 )
 gan_trainer.init_checkpoint(gan_ckpt)
 
+# Built once, so the stats derived constants are not recomputed for every tone
+postprocess = pnp.pipeline([
+    pnp.denormalize(normalization='specgan', stats=gan_stats),
+    pnp.invert_log_melspec(gan_hparams['sample_rate']),
+])
+
 def generate_tones(pitches):
     seed = tf.random.normal((len(pitches), gan_hparams['latent_size']))
     pitches = tf.one_hot(pitches, gan_hparams['cond_vector_size'], axis=1)
 
-    samples = gan.generator([seed, pitches], training=False)
-    samples = tf.reshape(samples, [-1, 256, 128])
-    audio = pro.pipeline([
-        pro.denormalize(normalization='specgan', stats=gan_stats),
-        pro.invert_log_melspec(gan_hparams['sample_rate']),
-        list,     # Stupid workaround becuase invert_log_melspec only does
-        np.array, # one spectrogram at a time
-    ])(samples)
-    return audio
+    samples = gan.generator([seed, pitches], training=False).numpy()
+    samples = np.reshape(samples, [-1, 256, 128])
+    return postprocess(samples)
 
 def generate_all_tones(pitches, amp):
     for a in range(0, len(pitches), 32):
@@ -5,6 +5,7 @@ import argparse
 import subprocess
 import os
 import importlib
+from models.common.precision import set_precision_policy
 from util import load_hparams, parse_train_args
 
 # Some compatability options for some graphics cards
@@ -28,4 +29,7 @@ if __name__ == '__main__':
     hparams = load_hparams(f'hparams/{args.model}.yml')
     hparams = parse_train_args(unknownargs, hparams)
 
+    # Has to be set before the models are created
+    set_precision_policy(hparams)
+
     generate.start(hparams)
@@ -0,0 +1,117 @@
+import tensorflow as tf
+import os
+import time
+import threading
+
+def snapshot_checkpoint(ckpt):
+    """
+    The tensors ckpt.save would write, as (key, slice spec, tensor), read
+    now. Reading a variable doesn't copy it, only its next update does, so
+    this is cheap and the tensors keep the values of this step while the
+    training goes on. There is no public API for this, the saver of the
+    checkpoint is used like ckpt.save uses it in the pinned TF 2.3.
+    """
+    snapshot = []
+    saveables, _, _ = ckpt._saver._gather_saveables()
+    for saveable in saveables:
+        for spec in saveable.specs:
+            # Reads the variable, as a copy on the CPU
+            snapshot.append((spec.name, spec.slice_spec, spec.tensor))
+    return snapshot
+
+class AsyncCheckpointManager():
+    """
+    Saves checkpoints like tf.train.CheckpointManager, to the same files and
+    with the same rotation, but writes them in a background thread. The
+    training only waits for the variables to be read, see
+    snapshot_checkpoint, the serialization and the write happen in the
+    thread. At most one save is in flight, a save waits for the previous one
+    to finish.
+    """
+    def __init__(self, ckpt, directory, max_to_keep):
+        self.ckpt = ckpt
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+
+        tf.io.gfile.makedirs(directory)
+        state = tf.train.get_checkpoint_state(directory)
+        self.checkpoints = [os.path.basename(path) for path in state.all_model_checkpoint_paths] if state else []
+        # The times of the checkpoints, without which tf.train.CheckpointManager
+        # would keep them forever
+        if state and len(state.all_model_checkpoint_timestamps) == len(self.checkpoints):
+            self.timestamps = list(state.all_model_checkpoint_timestamps)
+        else:
+            self.timestamps = [time.time()] * len(self.checkpoints)
+        self.last_preserved_timestamp = state.last_preserved_timestamp if state else time.time() - 1
+        self.latest_checkpoint = tf.train.latest_checkpoint(directory)
+
+        self.thread = None
+        self.error = None
+        self.write_duration = None
+
+    def save(self):
+        self.wait()
+        # Numbered like ckpt.save, and the counter is saved with the new number
+        name = f'ckpt-{int(self.ckpt.save_counter.assign_add(1).numpy())}'
+        snapshot = snapshot_checkpoint(self.ckpt)
+        self.thread = threading.Thread(target=self.write, args=(name, snapshot))
+        self.thread.start()
+        return os.path.join(self.directory, name)
+
+    def write(self, name, snapshot):
+        try:
+            start = time.time()
+
+            prefix = os.path.join(self.directory, f'{name}.tmp')
+            keys, slices, tensors = zip(*snapshot)
+            with tf.device('/cpu:0'):
+                tf.raw_ops.SaveV2(prefix=prefix, tensor_names=list(keys), shape_and_slices=list(slices),
+                                  tensors=list(tensors))
+
+            # The files are written under a temporary name and renamed, the
+            # index last, so a checkpoint is never partly there
+            files = sorted(tf.io.gfile.glob(f'{prefix}.*'), key=lambda f: f.endswith('.index'))
+            for f in files:
+                target = os.path.join(self.directory, name + f[len(prefix):])
+                tf.io.gfile.rename(f, target, overwrite=True)
+
+            self.checkpoints.append(name)
+            self.timestamps.append(time.time())
+            removed, self.checkpoints = self.checkpoints[:-self.max_to_keep], self.checkpoints[-self.max_to_keep:]
+            self.timestamps = self.timestamps[-self.max_to_keep:]
+            # The state is renamed into place, the old checkpoints are only
+            # removed once it doesn't list them
+            state = tf.compat.v1.train.generate_checkpoint_state_proto(
+                self.directory, name, self.checkpoints, all_model_checkpoint_timestamps=self.timestamps,
+                last_preserved_timestamp=self.last_preserved_timestamp)
+            path = os.path.join(self.directory, 'checkpoint')
+            with tf.io.gfile.GFile(f'{path}.tmp', 'w') as f:
+                f.write(str(state))
+            tf.io.gfile.rename(f'{path}.tmp', path, overwrite=True)
+            for old in removed:
+                for f in tf.io.gfile.glob(os.path.join(self.directory, f'{old}.*')):
+                    tf.io.gfile.remove(f)
+
+            self.latest_checkpoint = os.path.join(self.directory, name)
+            self.write_duration = time.time() - start
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Waits for the save in flight, if any, and raises its error if it
+        failed.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def pop_write_duration(self):
+        """
+        The duration of the last finished write in seconds, only once, or None.
+        """
+        duration, self.write_duration = self.write_duration, None
+        return duration
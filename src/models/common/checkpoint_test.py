@@ -0,0 +1,60 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+from models.common.checkpoint import AsyncCheckpointManager
+
+class TestAsyncCheckpointManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_checkpoint(self):
+        variable = tf.Variable(tf.zeros([4, 4]))
+        optimizer = tf.keras.optimizers.Adam(0.1)
+        ckpt = tf.train.Checkpoint(variable=variable, optimizer=optimizer)
+        return ckpt, variable, optimizer
+
+    def train(self, variable, optimizer):
+        optimizer.apply_gradients([(tf.ones_like(variable), variable)])
+
+    def checkpoint_files(self):
+        return sorted(f for f in os.listdir(self.directory) if f.startswith('ckpt-'))
+
+    def test_save_and_restore(self):
+        ckpt, variable, optimizer = self.create_checkpoint()
+        manager = AsyncCheckpointManager(ckpt, self.directory, max_to_keep=2)
+        for _ in range(4):
+            self.train(variable, optimizer)
+            saved = variable.numpy()
+            manager.save()
+            # The save in flight keeps the values it was started with
+            self.train(variable, optimizer)
+        manager.wait()
+
+        self.assertEqual(manager.checkpoints, ['ckpt-3', 'ckpt-4'])
+        self.assertEqual(self.checkpoint_files(), ['ckpt-3.data-00000-of-00001', 'ckpt-3.index',
+                                                   'ckpt-4.data-00000-of-00001', 'ckpt-4.index'])
+        self.assertEqual(tf.train.latest_checkpoint(self.directory), os.path.join(self.directory, 'ckpt-4'))
+
+        restored, restored_variable, restored_optimizer = self.create_checkpoint()
+        restarted = AsyncCheckpointManager(restored, self.directory, max_to_keep=2)
+        restored.restore(restarted.latest_checkpoint)
+        np.testing.assert_array_equal(restored_variable.numpy(), saved)
+        self.assertEqual(int(restored_optimizer.iterations.numpy()), 7)
+        self.assertEqual(int(restored.save_counter.numpy()), 4)
+
+        # The restarted training continues the numbering and the rotation
+        self.train(restored_variable, restored_optimizer)
+        restarted.save()
+        restarted.wait()
+        self.assertEqual(restarted.checkpoints, ['ckpt-4', 'ckpt-5'])
+        self.assertEqual(self.checkpoint_files(), ['ckpt-4.data-00000-of-00001', 'ckpt-4.index',
+                                                   'ckpt-5.data-00000-of-00001', 'ckpt-5.index'])
+        self.assertEqual(tf.train.CheckpointManager(restored, self.directory, max_to_keep=2).checkpoints,
+                         [os.path.join(self.directory, 'ckpt-4'), os.path.join(self.directory, 'ckpt-5')])
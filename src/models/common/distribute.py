@@ -0,0 +1,104 @@
+import tensorflow as tf
+import json
+import os
+
+# Data parallel training, set from the distribute hparam before anything
+# else runs in tensorflow:
+#   'none'         - a single device (the default)
+#   'mirrored'     - a replica per GPU, or replicas logical CPU devices on
+#                    machines without GPUs, in this process
+#   'multi_worker' - a replica per worker of the cluster in the TF_CONFIG
+#                    environment variable
+# The models and optimizers are created, and trained, in the scope of the
+# strategy. The trainer distributes the dataset and runs the train step on
+# every replica.
+# Every replica takes its part of each batch, so the batch_size hparam is
+# the global batch size.
+
+def create_strategy(hparams):
+    distribute = hparams['distribute'] if 'distribute' in hparams else 'none'
+    replicas = hparams['replicas'] if 'replicas' in hparams else 1
+
+    if distribute == 'mirrored':
+        if tf.config.experimental.list_physical_devices('GPU'):
+            strategy = tf.distribute.MirroredStrategy()
+        else:
+            # Splits the CPU into replicas devices, which run concurrently
+            cpu = tf.config.experimental.list_physical_devices('CPU')[0]
+            tf.config.experimental.set_virtual_device_configuration(
+                cpu, [tf.config.experimental.VirtualDeviceConfiguration() for _ in range(replicas)])
+            devices = [device.name for device in tf.config.experimental.list_logical_devices('CPU')]
+            # NCCL, the default all-reduce, is only for GPUs
+            strategy = tf.distribute.MirroredStrategy(devices, cross_device_ops=tf.distribute.ReductionToOneDevice())
+    elif distribute == 'multi_worker':
+        strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    elif distribute == 'none':
+        strategy = tf.distribute.get_strategy()
+    else:
+        raise Exception(f"No distribution strategy named '{distribute}'.")
+
+    print(f"Using distribution strategy {distribute} with {strategy.num_replicas_in_sync} replicas")
+    return strategy
+
+def is_distributed():
+    return tf.distribute.has_strategy()
+
+def task():
+    """
+    The type and index of this process in the TF_CONFIG cluster.
+    """
+    task = json.loads(os.environ.get('TF_CONFIG', '{}')).get('task', {})
+    return task.get('type', 'worker'), task.get('index', 0)
+
+def is_chief():
+    """
+    Whether this process writes the checkpoints and summaries of the
+    training, the other workers write theirs to their own directories.
+    """
+    cluster = json.loads(os.environ.get('TF_CONFIG', '{}')).get('cluster', {})
+    if 'chief' in cluster:
+        return task()[0] == 'chief'
+    return task()[1] == 0
+
+def replica_loss(loss):
+    """
+    Scales loss, a mean over the batch of a replica, so that the gradients
+    summed over the replicas are those of the mean over the global batch.
+    Has to be called inside the gradient tape.
+    """
+    replicas = tf.distribute.get_strategy().num_replicas_in_sync
+    if replicas > 1:
+        return loss / replicas
+    return loss
+
+def run(fn, *args):
+    """
+    Runs fn on every replica of the strategy in scope, with the parts of the
+    distributed values in args of the replica.
+    """
+    return tf.distribute.get_strategy().experimental_run_v2(fn, args=args)
+
+def mean(values):
+    """
+    The mean over the replicas of values returned by run.
+    """
+    strategy = tf.distribute.get_strategy()
+    return tf.nest.map_structure(lambda value: strategy.reduce(tf.distribute.ReduceOp.MEAN, value, axis=None), values)
+
+def local_batches(batch):
+    """
+    The parts of a distributed batch on the replicas of this worker.
+    """
+    strategy = tf.distribute.get_strategy()
+    parts = [strategy.experimental_local_results(x) for x in tf.nest.flatten(batch)]
+    return [tf.nest.pack_sequence_as(batch, [p[i] for p in parts]) for i in range(len(parts[0]))]
+
+def get_next_as_optional(iterator):
+    """
+    The next element of iterator as a tf.experimental.Optional, empty at the
+    end, for iterators of datasets and of distributed datasets.
+    """
+    if isinstance(iterator, tf.data.Iterator):
+        return tf.data.experimental.get_next_as_optional(iterator)
+    # Distributed iterators only have it as a method, from TF 2.3
+    return iterator.get_next_as_optional()
@@ -0,0 +1,17 @@
+import tensorflow as tf
+import tensorflow.keras.layers as tfkl
+
+class UpSampling2D(tfkl.Layer):
+    """
+    Nearest neighbour upsampling, the same as tf.keras.layers.UpSampling2D,
+    but by repeating the pixels instead of the resize op, which XLA can't
+    differentiate.
+    """
+    def __init__(self, size=(2, 2), **kwargs):
+        super(UpSampling2D, self).__init__(**kwargs)
+        self.size = size
+
+    def call(self, x):
+        _, h, w, c = x.shape
+        x = tf.tile(x[:, :, tf.newaxis, :, tf.newaxis, :], [1, 1, self.size[0], 1, self.size[1], 1])
+        return tf.reshape(x, [-1, h * self.size[0], w * self.size[1], c])
@@ -0,0 +1,44 @@
+import tensorflow as tf
+from tensorflow.keras.mixed_precision import experimental as mixed_precision
+
+# The precision policy is global, set from the precision hparam before any
+# model is created:
+#   'float32'        - everything in float32 (the default)
+#   'mixed_bfloat16' - compute in bfloat16, variables in float32
+#   'mixed_float16'  - compute in float16, variables in float32, with loss
+#                      scaling
+# Numerically sensitive parts (softmax, layer norm, masking, losses and
+# distributions) are kept in float32 by the models in either case.
+
+def set_precision_policy(hparams):
+    policy = hparams['precision'] if 'precision' in hparams else 'float32'
+    mixed_precision.set_policy(policy)
+    print(f"Using precision policy {policy}")
+
+def compute_dtype():
+    return mixed_precision.global_policy().compute_dtype
+
+def loss_scale_optimizer(optimizer):
+    """
+    Wraps optimizer for loss scaling if the policy computes in float16, or
+    returns it as is. Models keep the unwrapped optimizer for checkpoints,
+    so checkpoints are the same under every policy and only the dynamic
+    loss scale starts over when restoring.
+    """
+    if compute_dtype() == 'float16':
+        return mixed_precision.LossScaleOptimizer(optimizer, loss_scale='dynamic')
+    return optimizer
+
+def scale_loss(optimizer, loss):
+    """
+    Scales loss for an optimizer from loss_scale_optimizer. Has to be called
+    inside the gradient tape.
+    """
+    if isinstance(optimizer, mixed_precision.LossScaleOptimizer):
+        return optimizer.get_scaled_loss(loss)
+    return loss
+
+def unscale_gradients(optimizer, gradients):
+    if isinstance(optimizer, mixed_precision.LossScaleOptimizer):
+        return optimizer.get_unscaled_gradients(gradients)
+    return gradients
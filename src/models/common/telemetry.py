@@ -0,0 +1,157 @@
+import tensorflow as tf
+import time
+import json
+import numpy as np
+from util import peak_rss_mb
+import models.common.distribute as distribute
+
+class Telemetry():
+    """
+    Records where the time of every step goes, as phases like the input wait
+    and the compute, with the throughput and peak memory, to a json lines
+    file. The records cover the steps of an execution with
+    steps_per_execution, and there the input wait is only that of the first
+    batch. At the end of every epoch the 50th and 95th percentiles of the
+    phases per step and of the throughput are written to tensorboard and
+    the file. Records nothing without a path.
+    """
+    def __init__(self, path=None, count_tokens=None):
+        self.file = open(path, 'a') if path is not None else None
+        self.count_tokens = count_tokens
+        self.records = []
+        self.phases = {}
+        self.last = time.time()
+
+    def begin(self):
+        self.phases = {}
+        self.last = time.time()
+
+    def mark(self, phase, sync=None):
+        """
+        Adds the time since the last mark to phase. The tensors in sync, like
+        the stats of a train step, are waited for first, since the step may
+        still be running on the device.
+        """
+        if self.file is None:
+            return
+        if sync is not None:
+            for t in tf.nest.flatten(sync):
+                t.numpy()
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def end(self, epoch, step, steps, batch=None):
+        """
+        Records the phases since begin, or the last end, for steps steps on
+        batches like batch.
+        """
+        if self.file is None:
+            return
+
+        duration = sum(self.phases.values())
+        record = { 'epoch': int(epoch), 'step': int(step), 'steps': int(steps), 'time': self.phases }
+        if batch is not None and duration > 0:
+            # The examples of this worker, on all of its replicas
+            batches = distribute.local_batches(batch)
+            record['examples_per_sec'] = steps * sum(int(tf.shape(tf.nest.flatten(b)[0])[0]) for b in batches) / duration
+            if self.count_tokens is not None:
+                record['tokens_per_sec'] = steps * sum(int(self.count_tokens(b)) for b in batches) / duration
+        record['peak_rss_mb'] = peak_rss_mb()
+
+        self.records.append(record)
+        self.file.write(json.dumps(record) + '\n')
+        self.begin()
+
+    def summary(self, epoch, step, tsw=None):
+        """
+        Writes the percentiles over the steps of the epoch and the total time
+        of every phase, including the end of the epoch.
+        """
+        if self.file is None or not self.records:
+            return
+
+        steps = [r for r in self.records if r['steps'] > 0]
+        summary = {}
+        for phase in sorted({ phase for r in self.records for phase in r['time'] }):
+            per_step = [r['time'].get(phase, 0) / r['steps'] for r in steps]
+            if per_step:
+                summary[f'{phase}_p50'], summary[f'{phase}_p95'] = np.percentile(per_step, [50, 95])
+            summary[f'{phase}_total'] = sum(r['time'].get(phase, 0) for r in self.records)
+        for name in ['examples_per_sec', 'tokens_per_sec']:
+            values = [r[name] for r in steps if name in r]
+            if values:
+                summary[f'{name}_p50'], summary[f'{name}_p95'] = np.percentile(values, [50, 95])
+        summary['peak_rss_mb'] = max(r['peak_rss_mb'] for r in self.records)
+        summary = { name: float(value) for name, value in summary.items() }
+
+        if tsw is not None:
+            with tsw.as_default():
+                for name, value in summary.items():
+                    tf.summary.scalar(f'telemetry/{name}', value, step=step)
+        print(f"Epoch: {epoch}, Step: {step}, " + ", ".join(f"{name}: {value:.4f}" for name, value in summary.items()))
+
+        self.file.write(json.dumps({ 'epoch': int(epoch), 'step': int(step), 'summary': summary }) + '\n')
+        self.file.flush()
+        self.records = []
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class Profiler():
+    """
+    Captures tensorflow profiles of windows of steps, given as
+    'start-stop,...' like '500-520,1000-1010', into log_dir for the
+    tensorboard profile plugin. A window covers its steps from start to
+    stop, both included, with the input pipeline of the steps. With
+    steps_per_execution the windows are extended to whole executions.
+    """
+    def __init__(self, windows, log_dir):
+        self.windows = []
+        for window in str(windows).split(','):
+            if window.strip():
+                steps = window.split('-')
+                self.windows.append((int(steps[0]), int(steps[-1])))
+        self.log_dir = log_dir
+        self.active = None
+
+    def update(self, step):
+        """
+        Starts and stops the captures, called with the last step run before
+        the batch of the next step is taken. Returns whether it did.
+        """
+        if self.active is None and not self.windows:
+            return False
+
+        changed = False
+        if self.active is not None and step >= self.active[1]:
+            self.stop(step)
+            changed = True
+        if self.active is None:
+            # Windows that were passed, e.g. when resuming, are skipped
+            self.windows = [window for window in self.windows if window[1] > step]
+            for window in self.windows:
+                if window[0] <= step + 1:
+                    self.windows.remove(window)
+                    self.start(window)
+                    changed = True
+                    break
+        return changed
+
+    def start(self, window):
+        print(f"Profiling steps {window[0]} to {window[1]}")
+        self.active = window
+        tf.profiler.experimental.start(self.log_dir)
+
+    def stop(self, step):
+        tf.profiler.experimental.stop()
+        print(f"Wrote the profile of steps {self.active[0]} to {step} to {self.log_dir}")
+        self.active = None
+
+    def close(self, step):
+        """
+        Stops a capture still running at the end of the training.
+        """
+        if self.active is not None:
+            self.stop(step)
@@ -2,26 +2,283 @@ import tensorflow as tf
 import os
 import time
 import datetime
+import json
+import models.common.distribute as distribute
+from models.common.checkpoint import AsyncCheckpointManager
+from models.common.telemetry import Telemetry, Profiler
+
+class CompiledStep():
+    """
+    A train step compiled with XLA. Every new batch shape traces and
+    compiles the step again, so the batches should all have the same shape.
+    Keeps track of the number of compiles, the compile time and the step
+    time.
+    """
+    def __init__(self, train_step):
+        # Train steps are usually already tf.functions, compile the Python
+        # function they wrap instead
+        if hasattr(train_step, 'python_function'):
+            train_step = train_step.python_function
+
+        self.traces = 0
+        self.compiles = 0
+        self.compile_time = 0.0
+        self.step_time = 0.0
+        self.steps = 0
+
+        def step(batch):
+            # Only runs while tracing
+            self.traces += 1
+            return train_step(batch)
+        self.compiled_step = tf.function(step, experimental_compile=True)
+
+    def __call__(self, batch):
+        # Inside the multi-step loop of Trainer only the loop is timed
+        if not tf.executing_eagerly():
+            return self.compiled_step(batch)
+
+        traces = self.traces
+        start = time.time()
+        stats = self.compiled_step(batch)
+        duration = time.time() - start
+
+        # The first call can trace more than once, when variables are created
+        if self.traces > traces:
+            if self.compiles > 0:
+                shapes = tf.nest.map_structure(lambda x: x.shape.as_list(), batch)
+                print(f"Retraced the train step for batch shapes {shapes}")
+            print(f"Compiled the train step in {duration:.3f} seconds")
+            self.compiles += 1
+            self.compile_time += duration
+        else:
+            self.step_time += duration
+            self.steps += 1
+        return stats
+
+    def report(self):
+        """
+        Prints the stats and resets the step time.
+        """
+        if self.steps > 0:
+            print(f"Compiled train step: {self.step_time / self.steps:.3f} seconds per step, compiled {self.compiles} times, compiling took {self.compile_time:.3f} seconds")
+        else:
+            print(f"Compiled train step: traced {self.traces} times")
+        self.step_time = 0.0
+        self.steps = 0
+
+def compile_step(train_step, hparams):
+    """
+    Compiles train_step with XLA if the xla hparam is set, or runs it on
+    every replica with a distribution strategy.
+    """
+    if 'xla' in hparams and hparams['xla']:
+        if distribute.is_distributed():
+            raise Exception("XLA compiled train steps can't be distributed, the gradients are all-reduced in the optimizer.")
+        return CompiledStep(train_step)
+    if distribute.is_distributed():
+        return DistributedStep(train_step)
+    return train_step
+
+class DistributedStep():
+    """
+    Runs a train step on every replica of the distribution strategy in
+    scope, each on its part of a distributed batch, and returns the means of
+    their stats. The optimizers all-reduce the gradients of the replicas.
+    """
+    def __init__(self, train_step):
+        # The replicas can't all-reduce inside a tf.function of their own,
+        # the Python function the train step wraps is run instead
+        if hasattr(train_step, 'python_function'):
+            train_step = train_step.python_function
+        self.train_step = train_step
+        self.step = tf.function(self.distributed_step)
+
+    def distributed_step(self, batch):
+        return distribute.mean(distribute.run(self.train_step, batch))
+
+    def __call__(self, batch):
+        return self.step(batch)
+
+class GradientAccumulator():
+    """
+    A train step that sums the gradients of accum_steps batches in variables
+    on the device and then applies their mean, for batches too large to fit
+    in memory at once. The model has to implement compute_gradients(batch),
+    returning the gradients and the stats of the batch, apply_gradients and
+    train_variables, returning variables in the same structure as the
+    gradients. With a distribution strategy every replica sums its own
+    gradients, which are all-reduced when they are applied.
+    """
+    def __init__(self, model, accum_steps, hparams):
+        self.model = model
+        self.accum_steps = accum_steps
+        self.count = tf.Variable(0, trainable=False)
+
+        self.gradients = tf.nest.map_structure(lambda v: tf.Variable(tf.zeros_like(v), trainable=False,
+                                                                     synchronization=tf.VariableSynchronization.ON_READ,
+                                                                     aggregation=tf.VariableAggregation.SUM),
+                                               model.train_variables())
+
+        xla = hparams['xla'] if 'xla' in hparams else False
+        if distribute.is_distributed():
+            if xla:
+                raise Exception("XLA compiled train steps can't be distributed, the gradients are all-reduced in the optimizer.")
+            self.accumulate = DistributedStep(self.accumulate_step)
+            self.apply = tf.function(lambda: distribute.run(self.apply_step))
+        else:
+            self.accumulate = CompiledStep(self.accumulate_step) if xla else tf.function(self.accumulate_step)
+            self.apply = tf.function(self.apply_step, experimental_compile=xla)
+
+    def accumulate_step(self, batch):
+        gradients, stats = self.model.compute_gradients(batch)
+        for accumulated, gradient in zip(tf.nest.flatten(self.gradients), tf.nest.flatten(gradients)):
+            # Variables that don't affect the loss have no gradient
+            if gradient is not None:
+                accumulated.assign_add(tf.convert_to_tensor(gradient))
+        return stats
+
+    def apply_step(self):
+        self.model.apply_gradients(tf.nest.map_structure(lambda g: g / self.accum_steps, self.gradients))
+        for accumulated in tf.nest.flatten(self.gradients):
+            accumulated.assign(tf.zeros_like(accumulated))
+
+    def apply_and_reset(self):
+        self.apply()
+        self.count.assign(0)
+
+    def __call__(self, batch):
+        stats = self.accumulate(batch)
+        self.count.assign_add(1)
+        # A tf.cond and not an if, to also work inside the multi-step loop of
+        # Trainer
+        tf.cond(self.count >= self.accum_steps, self.apply_and_reset, lambda: None)
+        return stats
+
+    def report(self):
+        if isinstance(self.accumulate, CompiledStep):
+            self.accumulate.report()
+
+def create_train_step(model, hparams):
+    """
+    The train step for model, accumulating gradients over batches if the
+    accum_steps hparam is more than 1, and compiled with XLA if the xla
+    hparam is set.
+    """
+    accum_steps = hparams['accum_steps'] if 'accum_steps' in hparams else 1
+    if accum_steps > 1:
+        return GradientAccumulator(model, accum_steps, hparams)
+    return compile_step(model.train_step, hparams)
+
+class Metrics():
+    """
+    Running means of the scalar stats returned by the train steps, as Keras
+    metrics updated on the device. They are only read when flushed, which
+    writes them as summaries, prints them and starts over.
+    """
+    def __init__(self):
+        self.means = {}
+        self.steps = 0
+        self.update_replicas = tf.function(lambda stats, steps: distribute.run(self.update_means, stats, steps))
+
+    def update(self, stats, steps=1):
+        """
+        Adds stats, the means over steps steps.
+        """
+        for name in stats:
+            if name not in self.means:
+                self.means[name] = tf.keras.metrics.Mean(name)
+        if distribute.is_distributed():
+            # The metrics of a strategy can only be updated on the replicas.
+            # They all add the same means, which keeps them the same.
+            self.update_replicas(stats, tf.convert_to_tensor(steps))
+        else:
+            self.update_means(stats, steps)
+        self.steps += 1
+
+    def update_means(self, stats, steps):
+        for name, value in stats.items():
+            self.means[name].update_state(value, sample_weight=steps)
+
+    def flush(self, epoch, step, tsw=None):
+        if self.steps == 0:
+            return
+
+        results = {name: mean.result().numpy() for name, mean in self.means.items()}
+        if tsw is not None:
+            with tsw.as_default():
+                for name, value in results.items():
+                    tf.summary.scalar(name, value, step=step)
+        print(f"Epoch: {epoch}, Step: {step}, " + ", ".join(f"{name}: {value:.4f}" for name, value in results.items()))
+
+        for mean in self.means.values():
+            mean.reset_states()
+        self.steps = 0
+
+SAMPLE_REQUEST = 'sample_request.json'
+
+def write_sample_request(directory, request):
+    """
+    Replaces the sample request in the checkpoint directory, which the
+    sample worker polls. The file is renamed into place, so the worker never
+    reads half of it.
+    """
+    tf.io.gfile.makedirs(directory)
+    path = os.path.join(directory, SAMPLE_REQUEST)
+    with tf.io.gfile.GFile(f'{path}.tmp', 'w') as f:
+        json.dump(request, f)
+    tf.io.gfile.rename(f'{path}.tmp', path, overwrite=True)
+
+def read_sample_request(directory):
+    """
+    The sample request in the checkpoint directory, or None.
+    """
+    path = os.path.join(directory, SAMPLE_REQUEST)
+    if not tf.io.gfile.exists(path):
+        return None
+    with tf.io.gfile.GFile(path, 'r') as f:
+        return json.load(f)
 
 class Trainer():
     def __init__(self, dataset, hparams):
         self.dataset = dataset
         self.hparams = hparams
         self.step = tf.Variable(0)
+        self.epoch = tf.Variable(1)
+        self.iterator = None
+        self.count_tokens = None
+        self.curriculum = None
+        self.length = None
         self.train_summary_writer = None
+        self.train_log_dir = None
         self.ckpt = None
+        self.manager = None
+        self.metrics = Metrics()
 
     def init_tensorboard(self):
         # Tensorfboard logging
         current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        train_log_dir = f"./logs/{self.hparams['name']}/{current_time}/train/"
-        self.train_summary_writer = tf.summary.create_file_writer(train_log_dir)
+        self.train_log_dir = f"./logs/{self.hparams['name']}/{current_time}/train/"
+        if not distribute.is_chief():
+            self.train_log_dir = f"./logs/{self.hparams['name']}/{current_time}/%s_%d/" % distribute.task()
+        self.train_summary_writer = tf.summary.create_file_writer(self.train_log_dir)
 
     def init_checkpoint(self, ckpt):
         self.ckpt = ckpt
-        self.manager = tf.train.CheckpointManager(self.ckpt,
-                                                  os.path.join(self.hparams['save_dir'], 'ckpts', self.hparams['name']),
-                                                  max_to_keep=3)
+        if 'ckpt_iterator' in self.hparams and self.hparams['ckpt_iterator']:
+            # The position in the dataset, including the shuffle buffer and
+            # cache, is saved with the model, so that a restarted training
+            # continues in the middle of the epoch it stopped in
+            self.ckpt.epoch = self.epoch
+            self.ckpt.iterator = self.iterator = iter(self.epoch_dataset())
+        directory = os.path.join(self.hparams['save_dir'], 'ckpts', self.hparams['name'])
+        if not distribute.is_chief():
+            # Every worker has to save, but only the chief to the checkpoints
+            # that are restored
+            directory = os.path.join(directory, '%s_%d' % distribute.task())
+        if 'async_checkpoint' in self.hparams and self.hparams['async_checkpoint']:
+            self.manager = AsyncCheckpointManager(self.ckpt, directory, max_to_keep=3)
+        else:
+            self.manager = tf.train.CheckpointManager(self.ckpt, directory, max_to_keep=3)
 
         self.ckpt.restore(self.manager.latest_checkpoint)
         if self.manager.latest_checkpoint:
@@ -29,8 +286,130 @@ class Trainer():
         else:
             print("Initializing from scratch.")
 
+    def request_samples(self, step):
+        """
+        Signals the sample worker (sample_worker.py) to generate samples from
+        the first checkpoint at or after step into this run's tensorboard log,
+        instead of generating them in the training process. Only the last
+        request is kept, a busy worker skips to it.
+        """
+        if self.manager is None:
+            raise Exception("No checkpoint to sample from, call init_checkpoint on the trainer first.")
+        if self.train_log_dir is None:
+            raise Exception("No tensorboard log to write samples to, call init_tensorboard on the trainer first.")
+
+        write_sample_request(self.manager.directory, {
+            'time': time.time(),
+            'step': int(step),
+            'log_dir': os.path.abspath(self.train_log_dir),
+            'hparams': self.hparams,
+        })
+
+    def epoch_dataset(self):
+        steps_per_epoch = self.hparams['steps'] if 'steps' in self.hparams else None
+        dataset = self.dataset.take(steps_per_epoch) if steps_per_epoch > 0 else self.dataset
+
+        if 'ckpt_iterator' in self.hparams and self.hparams['ckpt_iterator']:
+            # The python functions of the pipelines, like the midi encoding,
+            # have no state that would need to be saved. The policy is from
+            # TF 2.2, before it iterators with them couldn't be saved at all.
+            options = tf.data.Options()
+            options.experimental_external_state_policy = tf.data.experimental.ExternalStatePolicy.IGNORE
+            dataset = dataset.with_options(options)
+
+        if distribute.is_distributed():
+            dataset = tf.distribute.get_strategy().experimental_distribute_dataset(dataset)
+        return dataset
+
     def set_train_step(self, train_step):
-        self.train_step = train_step
+        self.train_step = compile_step(train_step, self.hparams)
+
+    def set_model(self, model):
+        """
+        Trains model with the train step from create_train_step, instead of
+        set_train_step.
+        """
+        self.train_step = create_train_step(model, self.hparams)
+        # For the tokens per second of the telemetry
+        if hasattr(model, 'count_tokens'):
+            self.count_tokens = model.count_tokens
+
+    def set_curriculum(self, curriculum):
+        """
+        Trains on batches cropped by curriculum, an object with length(step),
+        the length to train step on, last_step(step), the last step on that
+        length or None, and crop(batch, length). The train steps are traced,
+        and compiled with XLA, once for every length.
+        """
+        self.curriculum = curriculum
+        self.crop_batch = tf.function(lambda batch, length: distribute.run(lambda b: curriculum.crop(b, length), batch))
+
+    def crop(self, batch, step):
+        """
+        Crops batch to the curriculum length of step, with a curriculum.
+        """
+        if self.curriculum is None:
+            return batch
+
+        length = self.curriculum.length(step)
+        if length != self.length:
+            print(f"Training on a length of {length} from step {step}")
+            self.length = length
+        return self.crop_batch(batch, length)
+
+    def execute_steps(self, batch, iterator, steps, length=None):
+        """
+        Runs train steps on batch and then on batches from iterator, up to
+        steps steps, as a single tf.function with steps_per_execution. With a
+        curriculum the batches from iterator are cropped to length, that of
+        batch. Returns the number of steps run and their stats, the scalar
+        stats being the mean over the steps and the rest the stats of the
+        last step.
+        """
+        first_stats = self.train_step(batch)
+        first = tf.nest.flatten(first_stats)
+        scalar = [s.shape.rank == 0 for s in first]
+
+        def add(totals, stats):
+            return [t + tf.cast(s, tf.float32) if sc else s for t, s, sc in zip(totals, stats, scalar)]
+
+        def body(i, done, totals):
+            batch = distribute.get_next_as_optional(iterator)
+            def step():
+                value = batch.get_value()
+                if length is not None:
+                    value = distribute.run(lambda b: self.curriculum.crop(b, length), value)
+                return i + 1, tf.constant(False), add(totals, tf.nest.flatten(self.train_step(value)))
+            return tf.cond(batch.has_value(), step, lambda: (i, tf.constant(True), totals))
+
+        totals = [tf.cast(s, tf.float32) if sc else s for s, sc in zip(first, scalar)]
+        # The last batch can be smaller
+        invariants = [tf.TensorShape([]) if sc else tf.TensorShape(None) for sc in scalar]
+        steps_run, _, totals = tf.while_loop(lambda i, done, _: tf.logical_and(i < steps, tf.logical_not(done)),
+                                             body, (tf.constant(1), tf.constant(False), totals),
+                                             shape_invariants=(tf.TensorShape([]), tf.TensorShape([]), invariants))
+
+        stats = [tf.cast(t / tf.cast(steps_run, tf.float32), s.dtype) if sc else t
+                 for t, s, sc in zip(totals, first, scalar)]
+        return steps_run, tf.nest.pack_sequence_as(first_stats, stats)
+
+    def checkpoint_stats(self, stats, step):
+        """
+        Adds the duration of the last background checkpoint write to stats,
+        once it has finished, and writes it as a summary.
+        """
+        if not isinstance(self.manager, AsyncCheckpointManager):
+            return stats
+
+        duration = self.manager.pop_write_duration()
+        if duration is None:
+            return stats
+
+        print(f"Wrote checkpoint {self.manager.latest_checkpoint} in {duration:.3f} seconds")
+        if self.train_summary_writer is not None:
+            with self.train_summary_writer.as_default():
+                tf.summary.scalar('checkpoint_write_time', duration, step=step)
+        return { **stats, 'checkpoint_write_time': duration }
 
     def on_epoch_start(self, epoch, step, tsw=None):
         pass
@@ -45,28 +424,121 @@ class Trainer():
         if self.train_step is None:
             raise Exception("No train_step specified, call set_train_step on the trainer with your training step.")
 
-        steps_per_epoch = self.hparams['steps'] if 'steps' in self.hparams else None
+        steps_per_execution = self.hparams['steps_per_execution'] if 'steps_per_execution' in self.hparams else 1
+        log_every_step = self.hparams['log_every_step'] if 'log_every_step' in self.hparams else 100
+        # Traced for every shape of the first batch, and length, so that the
+        # shapes stay static for every length of a curriculum
+        execute_steps = tf.function(self.execute_steps)
         stats = None
 
-        for epoch in range(1, self.hparams['epochs']+1):
+        if 'telemetry' in self.hparams and self.hparams['telemetry']:
+            log_dir = self.train_log_dir if self.train_log_dir is not None else self.hparams['save_dir']
+            telemetry = Telemetry(os.path.join(log_dir, 'telemetry.jsonl'), self.count_tokens)
+        else:
+            telemetry = Telemetry()
+
+        profiler = Profiler(self.hparams['profile_steps'] if 'profile_steps' in self.hparams else '',
+                            self.train_log_dir if self.train_log_dir is not None else self.hparams['save_dir'])
+
+        # With a saved iterator the epochs are counted from the start of the
+        # training, not of this run
+        first_epoch = int(self.epoch.numpy()) if self.iterator is not None else 1
+
+        for epoch in range(first_epoch, self.hparams['epochs']+1):
             start = time.time()
+            telemetry.begin()
             self.on_epoch_start(epoch, self.step.numpy(), tsw=self.train_summary_writer)
+            telemetry.mark('callbacks')
+
+            iterator = self.iterator if self.iterator is not None else iter(self.epoch_dataset())
+            if profiler.update(int(self.step.numpy())):
+                telemetry.mark('profiler')
 
-            d = self.dataset.take(steps_per_epoch) if steps_per_epoch > 0 else self.dataset
+            if steps_per_execution > 1:
+                # Runs steps_per_execution steps at a time without returning
+                # to Python. on_step only runs after each execution, with the
+                # stats from execute_steps.
+                s = int(self.step.numpy())
+                while True:
+                    # Executions end at multiples of steps_per_execution, so
+                    # that callbacks at multiples of it still run, and where
+                    # the length of the curriculum changes
+                    steps = steps_per_execution - s % steps_per_execution
+                    last = self.curriculum.last_step(s + 1) if self.curriculum is not None else None
+                    if last is not None:
+                        steps = min(steps, last - s)
+                    # The first batch is taken here, since an execution
+                    # failing on an exhausted iterator could still update
+                    # some variables, like the optimizer iterations
+                    batch = next(iterator, None)
+                    if batch is None:
+                        break
+                    # The whole execution trains on the length of its first
+                    # step
+                    batch = self.crop(batch, s + 1)
+                    telemetry.mark('input_wait')
+                    steps_run, stats = execute_steps(batch, iterator, tf.constant(steps), self.length)
+                    telemetry.mark('compute', sync=stats)
+                    self.metrics.update(stats, steps_run)
+                    self.step.assign_add(steps_run)
+                    previous, s = s, int(self.step.numpy())
+                    self.on_step(epoch, s, self.checkpoint_stats(stats, s), tsw=self.train_summary_writer)
+                    if s // log_every_step > previous // log_every_step:
+                        self.metrics.flush(epoch, s, tsw=self.train_summary_writer)
+                    telemetry.mark('callbacks')
+                    if 'ckpt_every_step' in self.hparams and s // self.hparams['ckpt_every_step'] > previous // self.hparams['ckpt_every_step']:
+                        if self.ckpt is not None:
+                            self.manager.save()
+                    telemetry.mark('checkpoint')
+                    if profiler.update(s):
+                        telemetry.mark('profiler')
+                    telemetry.end(epoch, s, s - previous, batch)
+            else:
+                for batch in iterator:
+                    batch = self.crop(batch, self.step.numpy() + 1)
+                    telemetry.mark('input_wait')
+                    self.step.assign_add(1)
+                    s = self.step.numpy()
+                    stats = self.train_step(batch)
+                    telemetry.mark('compute', sync=stats)
+                    self.metrics.update(stats)
+                    self.on_step(epoch, s, self.checkpoint_stats(stats, s), tsw=self.train_summary_writer)
+                    if s % log_every_step == 0:
+                        self.metrics.flush(epoch, s, tsw=self.train_summary_writer)
+                    telemetry.mark('callbacks')
+                    if 'ckpt_every_step' in self.hparams and s % self.hparams['ckpt_every_step'] == 0:
+                        if self.ckpt is not None:
+                            self.manager.save()
+                    telemetry.mark('checkpoint')
+                    if profiler.update(s):
+                        telemetry.mark('profiler')
+                    telemetry.end(epoch, s, 1, batch)
 
-            for batch in d:
-                self.step.assign_add(1)
-                s = self.step.numpy()
-                stats = self.train_step(batch)
-                self.on_step(epoch, s, stats, tsw=self.train_summary_writer)
-                if 'ckpt_every_step' in self.hparams and s % self.hparams['ckpt_every_step'] == 0:
-                    if self.ckpt is not None:
-                        self.manager.save()
+            # The end of the epoch is recorded without steps
+            telemetry.mark('input_wait')
+
+            if self.iterator is not None and epoch < self.hparams['epochs']:
+                # The checkpoints from here on continue with the next epoch
+                self.epoch.assign(epoch + 1)
+                self.ckpt.iterator = self.iterator = iter(self.epoch_dataset())
+                telemetry.mark('input_wait')
 
             if 'ckpt_every_step' not in self.hparams and self.ckpt is not None:
                 self.manager.save()
+            telemetry.mark('checkpoint')
 
             end = time.time()
             duration = end - start
+            self.metrics.flush(epoch, self.step.numpy(), tsw=self.train_summary_writer)
+            if hasattr(self.train_step, 'report'):
+                self.train_step.report()
             self.on_epoch_complete(epoch, self.step.numpy(), duration, tsw=self.train_summary_writer)
+            telemetry.mark('callbacks')
+            telemetry.end(epoch, self.step.numpy(), 0)
+            telemetry.summary(epoch, self.step.numpy(), tsw=self.train_summary_writer)
+
+        profiler.close(self.step.numpy())
+        telemetry.close()
+        if isinstance(self.manager, AsyncCheckpointManager):
+            self.manager.wait()
         return stats
@@ -0,0 +1,174 @@
+import unittest
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+from models.common.training import Trainer
+from models.common.distribute import create_strategy, replica_loss
+from models.transformer.curriculum import Curriculum
+
+# The mirrored strategy splits the CPU into two replicas, which has to be
+# done before tensorflow initializes its devices, so before any test runs
+try:
+    mirrored = create_strategy({ 'distribute': 'mirrored', 'replicas': 2 })
+except RuntimeError:
+    mirrored = None
+
+class Stop(Exception):
+    pass
+
+class Linear():
+    """
+    A linear regression with the train step interface of the models.
+    """
+    def __init__(self):
+        self.weights = tf.Variable(np.linspace(-1, 1, 3).reshape([3, 1]), dtype=tf.float32)
+        self.optimizer = tf.keras.optimizers.SGD(0.1)
+
+    def compute_gradients(self, batch):
+        x, y = batch
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.square(tf.matmul(x, self.weights) - y))
+            scaled_loss = replica_loss(loss)
+        return tape.gradient(scaled_loss, self.train_variables()), { 'loss': loss }
+
+    def apply_gradients(self, gradients):
+        self.optimizer.apply_gradients(zip(gradients, self.train_variables()))
+
+    def train_variables(self):
+        return [self.weights]
+
+    def train_step(self, batch):
+        gradients, stats = self.compute_gradients(batch)
+        self.apply_gradients(gradients)
+        return stats
+
+class TestTrainer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_trainer(self, name, stop_at=None, **hparams):
+        hparams = { 'name': name, 'save_dir': self.directory, 'epochs': 2, 'steps': 0, 'log_every_step': 1000, **hparams }
+        # A python function and a shuffle buffer, like the midi pipelines
+        dataset = tf.data.Dataset.range(40).map(lambda x: tf.py_function(lambda x: x, [x], tf.int64))
+        dataset = dataset.shuffle(10, seed=0).batch(2)
+        trainer = Trainer(dataset, hparams)
+
+        total = tf.Variable(0, dtype=tf.int64)
+        trainer.batches = []
+        def train_step(batch):
+            trainer.batches.append(batch.numpy())
+            total.assign_add(tf.reduce_sum(batch))
+            return { 'total': total }
+        trainer.set_train_step(train_step)
+
+        def on_step(epoch, step, stats, tsw=None):
+            if stop_at is not None and step >= stop_at:
+                raise Stop()
+        trainer.on_step = on_step
+
+        trainer.init_checkpoint(tf.train.Checkpoint(step=trainer.step, total=total))
+        return trainer
+
+    def assert_resumes(self, **hparams):
+        expected = self.create_trainer('uninterrupted', **hparams)
+        expected.run()
+        self.assertEqual(len(expected.batches), 40)
+
+        stopped = self.create_trainer('stopped', stop_at=13, **hparams)
+        with self.assertRaises(Stop):
+            stopped.run()
+        if hasattr(stopped.manager, 'wait'):
+            stopped.manager.wait()
+
+        # Restored from the checkpoint at step 10, in the first epoch
+        resumed = self.create_trainer('stopped', **hparams)
+        self.assertEqual(int(resumed.step.numpy()), 10)
+        self.assertEqual(int(resumed.epoch.numpy()), 1)
+        resumed.run()
+        self.assertEqual(len(resumed.batches), 30)
+        for batch, e in zip(resumed.batches, expected.batches[10:]):
+            np.testing.assert_array_equal(batch, e)
+
+    def test_resume_iterator(self):
+        self.assert_resumes(ckpt_iterator=True, ckpt_every_step=5)
+
+    def test_resume_iterator_async_checkpoint(self):
+        self.assert_resumes(ckpt_iterator=True, ckpt_every_step=5, async_checkpoint=True)
+
+    def curriculum_lengths(self, steps_per_execution):
+        hparams = { 'name': 'curriculum', 'save_dir': self.directory, 'epochs': 1, 'steps': 0, 'log_every_step': 1000,
+                    'steps_per_execution': steps_per_execution }
+        frames = np.arange(20 * 8).reshape([20, 8])
+        trainer = Trainer(tf.data.Dataset.from_tensor_slices((frames, frames)).batch(2), hparams)
+
+        step = tf.Variable(0)
+        lengths = tf.Variable(tf.zeros([10, 2], dtype=tf.int32))
+        def train_step(batch):
+            inp, tar = batch
+            lengths.scatter_nd_update(tf.reshape(step, [1, 1]), [[tf.shape(inp)[1], tf.shape(tar)[1]]])
+            step.assign_add(1)
+            return { 'length': tf.cast(tf.shape(inp)[1], tf.float32) }
+        trainer.set_train_step(train_step)
+        # Lengths of 4 up to step 3 and 6 up to step 7, then the frame size
+        trainer.set_curriculum(Curriculum('4:3,6:7', 8))
+
+        trainer.run()
+        self.assertEqual(int(trainer.step.numpy()), 10)
+        return lengths.numpy()
+
+    def test_curriculum(self):
+        expected = [[length, length] for length in [4, 4, 4, 6, 6, 6, 6, 8, 8, 8]]
+        for steps_per_execution in [1, 3, 4]:
+            with self.subTest(steps_per_execution=steps_per_execution):
+                np.testing.assert_array_equal(self.curriculum_lengths(steps_per_execution), expected)
+
+class TestGradientAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.normal(size=[16, 3]).astype(np.float32)
+        self.y = rng.normal(size=[16, 1]).astype(np.float32)
+
+    def accumulate(self, accum_steps, steps_per_execution):
+        hparams = { 'name': 'accumulate', 'save_dir': '', 'epochs': 1, 'steps': 0, 'log_every_step': 1000,
+                    'accum_steps': accum_steps, 'steps_per_execution': steps_per_execution }
+        model = Linear()
+        trainer = Trainer(tf.data.Dataset.from_tensor_slices((self.x, self.y)).batch(2), hparams)
+        trainer.set_model(model)
+        trainer.run()
+        return int(model.optimizer.iterations.numpy()), model.weights.numpy()
+
+    def assert_same_update(self, steps_per_execution=1, strategy=None):
+        # The batches of 2 accumulated 4 times, like batches of 8
+        if strategy is not None:
+            with strategy.scope():
+                iterations, weights = self.accumulate(4, steps_per_execution)
+        else:
+            iterations, weights = self.accumulate(4, steps_per_execution)
+
+        expected = Linear()
+        for i in range(0, 16, 8):
+            expected.train_step((self.x[i:i+8], self.y[i:i+8]))
+
+        self.assertEqual(iterations, 2)
+        np.testing.assert_allclose(weights, expected.weights.numpy(), rtol=1e-5, atol=1e-6)
+
+    def test_accumulate(self):
+        self.assert_same_update()
+
+    def test_accumulate_steps_per_execution(self):
+        for steps_per_execution in [3, 4]:
+            with self.subTest(steps_per_execution=steps_per_execution):
+                self.assert_same_update(steps_per_execution)
+
+    def test_accumulate_mirrored(self):
+        if mirrored is None:
+            self.skipTest("The devices were initialized before the mirrored strategy could split them.")
+        for steps_per_execution in [1, 4]:
+            with self.subTest(steps_per_execution=steps_per_execution):
+                self.assert_same_update(steps_per_execution, mirrored)
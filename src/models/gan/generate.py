@@ -4,6 +4,7 @@ from models.gan.model import GAN
 import librosa
 import matplotlib.pyplot as plt
 import data.process as pro
+import data.process_np as pnp
 import numpy as np
 
 def generate(hparams, seed, pitches):
@@ -26,12 +27,11 @@ def generate(hparams, seed, pitches):
     #seed = tf.repeat(seed, count, axis=0)
     pitches = tf.one_hot(pitches, hparams['cond_vector_size'], axis=1)
 
-    samples = tf.reshape(gan.generator([seed, pitches], training=False), [-1, 256, 128])
-    audio = pro.pipeline([
-        pro.denormalize(normalization='specgan', stats=gan_stats),
-        pro.invert_log_melspec(hparams['sample_rate']),
-        list,     # Stupid workaround becuase invert_log_melspec only does
-        np.array, # one spectrogram at a time
+    samples = gan.generator([seed, pitches], training=False).numpy()
+    samples = np.reshape(samples, [-1, 256, 128])
+    audio = pnp.pipeline([
+        pnp.denormalize(normalization='specgan', stats=gan_stats),
+        pnp.invert_log_melspec(hparams['sample_rate']),
     ])(samples)
     return samples, audio
 
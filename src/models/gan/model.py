@@ -1,6 +1,9 @@
 import tensorflow as tf
 import tensorflow.keras as tfk
 import tensorflow.keras.layers as tfkl
+from models.common.layers import UpSampling2D
+import models.common.precision as precision
+import models.common.distribute as distribute
 
 class GAN():
     def __init__(self, shape, hparams):
@@ -10,23 +13,38 @@ class GAN():
 
         self.generator_optimizer = tfk.optimizers.Adam(self.hparams['gen_lr'])
         self.discriminator_optimizer = tfk.optimizers.Adam(self.hparams['disc_lr'])
+        self.generator_train_optimizer = precision.loss_scale_optimizer(self.generator_optimizer)
+        self.discriminator_train_optimizer = precision.loss_scale_optimizer(self.discriminator_optimizer)
 
         self.generator = self.create_generator()
         self.discriminator = self.create_discriminator()
 
-        self.cross_entropy = tfk.losses.BinaryCrossentropy(from_logits=True)
-        self.categorical_cross_entropy = tfk.losses.CategoricalCrossentropy()
+        # Per example, the losses take the means over the batch themselves,
+        # which is the batch of the replica with a distribution strategy
+        self.cross_entropy = tfk.losses.BinaryCrossentropy(from_logits=True, reduction='none')
+        self.categorical_cross_entropy = tfk.losses.CategoricalCrossentropy(reduction='none')
 
     @tf.function
     def train_step(self, x):
-        noise = tf.random.normal([self.hparams['batch_size'], self.hparams['latent_size']])
-        pitches = tf.random.uniform([self.hparams['batch_size']], 0, self.hparams['cond_vector_size'], dtype=tf.int32)
-        fake_pitch_index = tf.one_hot(pitches, self.hparams['cond_vector_size'], axis=1)
-        # fake_pitch = tf.one_hot(pitches, self.hparams['cond_vector_size'], axis=1)
-
+        gradients, stats = self.compute_gradients(x)
+        self.apply_gradients(gradients)
+        return stats
+
+    def compute_gradients(self, x):
+        """
+        The generator and discriminator gradients on x, in the same structure
+        as train_variables, and the losses returned by train_step.
+        """
         real_spec = x['audio']
         real_pitch_index = x['pitch']
 
+        # As many fakes as reals, also for a smaller last batch
+        batch_size = tf.shape(real_spec)[0]
+        noise = tf.random.normal([batch_size, self.hparams['latent_size']])
+        pitches = tf.random.uniform([batch_size], 0, self.hparams['cond_vector_size'], dtype=tf.int32)
+        fake_pitch_index = tf.one_hot(pitches, self.hparams['cond_vector_size'], axis=1)
+        # fake_pitch = tf.one_hot(pitches, self.hparams['cond_vector_size'], axis=1)
+
         with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
             fake_spec = self.generator([noise, fake_pitch_index], training=True)
 
@@ -36,33 +54,44 @@ class GAN():
             gen_loss = self.generator_loss(fake_output, fake_aux, fake_pitch_index)
             disc_loss = self.discriminator_loss(real_output, fake_output, real_aux, real_pitch_index, fake_aux, fake_pitch_index)
 
-        gradients_of_generator = gen_tape.gradient(gen_loss, self.generator.trainable_variables)
-        gradients_of_discriminator = disc_tape.gradient(disc_loss, self.discriminator.trainable_variables)
+            scaled_gen_loss = precision.scale_loss(self.generator_train_optimizer, distribute.replica_loss(gen_loss))
+            scaled_disc_loss = precision.scale_loss(self.discriminator_train_optimizer, distribute.replica_loss(disc_loss))
+
+        gradients_of_generator = gen_tape.gradient(scaled_gen_loss, self.generator.trainable_variables)
+        gradients_of_discriminator = disc_tape.gradient(scaled_disc_loss, self.discriminator.trainable_variables)
+
+        gradients_of_generator = precision.unscale_gradients(self.generator_train_optimizer, gradients_of_generator)
+        gradients_of_discriminator = precision.unscale_gradients(self.discriminator_train_optimizer, gradients_of_discriminator)
+
+        return (gradients_of_generator, gradients_of_discriminator), {'gen_loss': gen_loss, 'disc_loss': disc_loss}
 
-        self.generator_optimizer.apply_gradients(zip(gradients_of_generator, self.generator.trainable_variables))
-        self.discriminator_optimizer.apply_gradients(zip(gradients_of_discriminator, self.discriminator.trainable_variables))
+    def apply_gradients(self, gradients):
+        gradients_of_generator, gradients_of_discriminator = gradients
+        self.generator_train_optimizer.apply_gradients(zip(gradients_of_generator, self.generator.trainable_variables))
+        self.discriminator_train_optimizer.apply_gradients(zip(gradients_of_discriminator, self.discriminator.trainable_variables))
 
-        return gen_loss, disc_loss
+    def train_variables(self):
+        return self.generator.trainable_variables, self.discriminator.trainable_variables
 
     def discriminator_loss(self, real_output, fake_output, real_aux, real_pitch_index, fake_aux, fake_pitch_index):
-        real_loss = self.cross_entropy(
-            tf.ones_like(real_output)-tf.random.uniform(real_output.shape, 0, 0.1), # Add random to smooth real labels
-            real_output)
-        fake_loss = self.cross_entropy(
-            tf.zeros_like(fake_output)+tf.random.uniform(fake_output.shape, 0, 0.1), # Subtract random to smooth fake labels
-            fake_output)
-        real_aux_loss = self.categorical_cross_entropy(
-            real_pitch_index, real_aux)
-        fake_aux_loss = self.categorical_cross_entropy(
-            fake_pitch_index, fake_aux)
+        real_loss = tf.reduce_mean(self.cross_entropy(
+            tf.ones_like(real_output)-tf.random.uniform(tf.shape(real_output), 0, 0.1), # Add random to smooth real labels
+            real_output))
+        fake_loss = tf.reduce_mean(self.cross_entropy(
+            tf.zeros_like(fake_output)+tf.random.uniform(tf.shape(fake_output), 0, 0.1), # Subtract random to smooth fake labels
+            fake_output))
+        real_aux_loss = tf.reduce_mean(self.categorical_cross_entropy(
+            real_pitch_index, real_aux))
+        fake_aux_loss = tf.reduce_mean(self.categorical_cross_entropy(
+            fake_pitch_index, fake_aux))
 
         total_loss = real_loss + fake_loss + real_aux_loss + fake_aux_loss
         return total_loss
 
     def generator_loss(self, fake_output, fake_aux, fake_pitch_index):
-        fake_aux_loss = self.categorical_cross_entropy(
-            fake_pitch_index, fake_aux)
-        source_loss = self.cross_entropy(tf.ones_like(fake_output), fake_output)
+        fake_aux_loss = tf.reduce_mean(self.categorical_cross_entropy(
+            fake_pitch_index, fake_aux))
+        source_loss = tf.reduce_mean(self.cross_entropy(tf.ones_like(fake_output), fake_output))
         return source_loss + fake_aux_loss * self.hparams['aux_loss_weight']
 
     def create_generator(self):
@@ -83,13 +112,14 @@ class GAN():
         o = tfkl.BatchNormalization()(o)
         o = tfkl.LeakyReLU()(o)
 
-        o = tfkl.UpSampling2D(size=(2, 2))(o)
+        o = UpSampling2D(size=(2, 2))(o)
         o = tfkl.Conv2D(64, (5, 5), strides=(1, 1), padding='same', use_bias=False)(o)
         o = tfkl.BatchNormalization()(o)
         o = tfkl.LeakyReLU()(o)
 
-        o = tfkl.UpSampling2D(size=(2, 2))(o)
-        o = tfkl.Conv2D(1, (5, 5), strides=(1, 1), padding='same', use_bias=False, activation='tanh')(o)
+        o = UpSampling2D(size=(2, 2))(o)
+        # The outputs are float32 with mixed precision
+        o = tfkl.Conv2D(1, (5, 5), strides=(1, 1), padding='same', use_bias=False, activation='tanh', dtype='float32')(o)
 
 
         return tf.keras.Model(inputs=[latent, pitch_class], outputs=o)
@@ -123,8 +153,9 @@ class GAN():
         o = tfkl.BatchNormalization()(o)
         o = tfkl.LeakyReLU()(o)
 
-        fake = tfkl.Dense(1)(o)
-        aux = tfkl.Dense(self.hparams['cond_vector_size'], activation='softmax', name='auxillary')(o)
+        # The outputs, including the softmax, are float32 with mixed precision
+        fake = tfkl.Dense(1, dtype='float32')(o)
+        aux = tfkl.Dense(self.hparams['cond_vector_size'], activation='softmax', name='auxillary', dtype='float32')(o)
 
         return tf.keras.Model(inputs=image, outputs=[fake, aux])
 
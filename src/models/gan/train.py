@@ -5,43 +5,38 @@ import functools
 import data.process as pro
 from models.common.training import Trainer
 from data.nsynth import nsynth_from_tfrecord, nsynth_to_melspec
+from data.melstore import melspec_store, melspec_store_exists, build_melspec_store
 from models.gan.model import GAN
 import data.process as pro
 import tensorflow_datasets as tfds
 import matplotlib.pyplot as plt
 import io
 
-# Define some metrics to be used in the training
-gen_loss_avg = tf.keras.metrics.Mean()
-disc_loss_avg = tf.keras.metrics.Mean()
+def create_dataset(hparams):
+    if 'num_parallel_calls' in hparams:
+        pro.set_num_parallel_calls(hparams['num_parallel_calls'])
 
+    # The compiled train step needs every batch to have the same shape
+    drop_remainder = hparams['xla'] if 'xla' in hparams else False
 
-# This runs at the start of every epoch
-def on_epoch_start(epoch, step, tsw):
-    gen_loss_avg = tf.keras.metrics.Mean()
-    disc_loss_avg = tf.keras.metrics.Mean()
+    store = hparams['melspec_store'] if 'melspec_store' in hparams else None
 
+    if store:
+        if not melspec_store_exists(store):
+            dataset = tfds.load('nsynth/gansynth_subset', split='train', shuffle_files=True)
+            gan_stats = calculate_dataset_stats(hparams, dataset)
+            build_melspec_store(nsynth_to_melspec(dataset, hparams, gan_stats), store,
+                                stats=gan_stats,
+                                dtype=hparams['melspec_store_dtype'] if 'melspec_store_dtype' in hparams else 'float16')
+        dataset = melspec_store(store, hparams['cond_vector_size'])
+    else:
+        # Load nsynth dataset from tfds
+        dataset = tfds.load('nsynth/gansynth_subset', split='train', shuffle_files=True)
 
-# This runs at every step in the training (for each batch in dataset)
-def on_step(epoch, step, stats, tsw):
-    gen_loss, disc_loss = stats
-    gen_loss_avg(gen_loss)
-    disc_loss_avg(disc_loss)
-    with tsw.as_default():
-        tf.summary.scalar('gen_loss', gen_loss_avg.result(), step=step)
-        tf.summary.scalar('disc_loss', disc_loss_avg.result(), step=step)
-    if step % 100 == 0:
-        print(f"Epoch: {epoch}, Step: {step}, Gen Loss: {gen_loss_avg.result()}, Disc Loss: {disc_loss_avg.result()}")
+        gan_stats = calculate_dataset_stats(hparams, dataset)
+        #gan_stats = np.load('gan_stats.npz')
 
-def start(hparams):
-
-    # Load nsynth dataset from tfds
-    dataset = tfds.load('nsynth/gansynth_subset', split='train', shuffle_files=True)
-
-    gan_stats = calculate_dataset_stats(hparams, dataset)
-    #gan_stats = np.load('gan_stats.npz')
-
-    dataset = nsynth_to_melspec(dataset, hparams, gan_stats)
+        dataset = nsynth_to_melspec(dataset, hparams, gan_stats)
 
     # Determine shape of the spectograms in the dataset
     spec_shape = None
@@ -62,20 +57,27 @@ def start(hparams):
     dataset = pro.index_map('audio', pro.reshape([*spec_shape, 1]))(dataset)
 
     # Create preprocessing pipeline for shuffling and batching
-    dataset = pro.pipeline([
-        pro.cache(),
+    if store:
+        # The store is already shuffled on read
+        return pro.pipeline([
+            pro.cache_placement(hparams['cache'] if 'cache' in hparams else 'none'),
+            pro.batch(hparams['batch_size'], drop_remainder),
+            pro.prefetch(hparams['prefetch'] if 'prefetch' in hparams else tf.data.experimental.AUTOTUNE),
+        ])(dataset)
+
+    return pro.pipeline([
+        pro.cache_placement(hparams['cache'] if 'cache' in hparams else 'memory'),
         pro.shuffle(hparams['buffer_size']),
-        pro.batch(hparams['batch_size']),
-        pro.prefetch()
+        pro.batch(hparams['batch_size'], drop_remainder),
+        pro.prefetch(hparams['prefetch'] if 'prefetch' in hparams else tf.data.experimental.AUTOTUNE),
     ])(dataset)
 
-    gan = GAN(spec_shape, hparams)
-    gan.discriminator.summary()
-    gan.generator.summary()
-
-
-    # This runs at the end of every epoch and is used to display metrics
-    def on_epoch_complete(epoch, step, duration, tsw):
+def create_sampler(gan):
+    """
+    Returns a function generating spectrograms with the generator of gan and
+    writing them to a summary writer, in training or in the sample worker.
+    """
+    def generate_image(step, tsw):
         #display.clear_output(wait=True)
         count = 6
         seed = tf.random.normal((count, gan.hparams['latent_size']))
@@ -100,7 +102,38 @@ def start(hparams):
 
         with tsw.as_default():
             tf.summary.image(f'Spectrogram', image, step=step)
-        print(f"Epoch: {epoch}, Step: {step}, Gen Loss: {gen_loss_avg.result()}, Disc Loss: {disc_loss_avg.result()}, Duration: {duration} s")
+
+    return generate_image
+
+def sampler(hparams):
+    """
+    Creates the GAN for the sample worker. Returns the objects to restore
+    from the training checkpoint and the sampling function.
+    """
+    gan = GAN(tuple(hparams['spec_shape']), hparams)
+    return { 'generator': gan.generator }, create_sampler(gan)
+
+def start(hparams):
+    dataset = create_dataset(hparams)
+    spec_shape = tuple(dataset.element_spec['audio'].shape[1:3])
+    # The sample worker creates the GAN from the hparams of the trainer
+    hparams = { **hparams, 'spec_shape': list(spec_shape) }
+
+    gan = GAN(spec_shape, hparams)
+    gan.discriminator.summary()
+    gan.generator.summary()
+
+
+    sample_worker = hparams['sample_worker'] if 'sample_worker' in hparams else False
+    generate_image = None if sample_worker else create_sampler(gan)
+
+    # This runs at the end of every epoch and is used to display metrics
+    def on_epoch_complete(epoch, step, duration, tsw):
+        if sample_worker:
+            trainer.request_samples(step)
+        else:
+            generate_image(step, tsw)
+        print(f"Epoch: {epoch}, Step: {step}, Duration: {duration} s")
 
 
     trainer = Trainer(dataset, hparams)
@@ -115,9 +148,7 @@ def start(hparams):
 
     trainer.init_checkpoint(ckpt)
     trainer.init_tensorboard()
-    trainer.set_train_step(gan.train_step)
-    trainer.on_epoch_start = on_epoch_start
-    trainer.on_step = on_step
+    trainer.set_model(gan)
     trainer.on_epoch_complete = on_epoch_complete
 
     trainer.run()
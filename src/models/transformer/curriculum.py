@@ -0,0 +1,46 @@
+class Curriculum():
+    """
+    Trains on shorter frames first and grows them in stages, given as
+    'length:step,...' like '64:2000,128:6000,256:12000', training on frames
+    of 64 tokens up to step 2000, then 128 up to step 6000 and so on, and on
+    the full frame_size after the last stage. Set on the trainer with
+    set_curriculum, which crops the batches of every step.
+    """
+    def __init__(self, stages, frame_size):
+        self.stages = []
+        for stage in str(stages).split(','):
+            if stage.strip():
+                length, step = stage.split(':')
+                self.stages.append((int(length), int(step)))
+        self.stages.sort(key=lambda stage: stage[1])
+        for length, _ in self.stages:
+            if length < 2 or length > frame_size:
+                raise Exception(f"No curriculum stage of length {length} for a frame_size of {frame_size}.")
+        self.frame_size = frame_size
+
+    def length(self, step):
+        """
+        The frame length step trains on.
+        """
+        for length, last in self.stages:
+            if step <= last:
+                return length
+        return self.frame_size
+
+    def last_step(self, step):
+        """
+        The last step training on the length of step, None when it is the
+        full frame_size from there on.
+        """
+        for _, last in self.stages:
+            if step <= last:
+                return last
+        return None
+
+    def crop(self, batch, length):
+        """
+        Crops a batch of (inp, tar) frames to length around the split between
+        them, so that the target still continues the input.
+        """
+        inp, tar = batch
+        return inp[:, -length:], tar[:, :length]
@@ -4,7 +4,7 @@ import numpy as np
 from models.common.training import Trainer
 import data.process as pro
 import data.midi as M
-from models.transformer.model import Transformer
+from models.transformer.model import create_transformer
 import matplotlib.pyplot as plt
 import tensorflow_datasets as tfds
 
@@ -21,11 +21,11 @@ def generate(hparams):
         pro.unbatch(),
     ])(dataset).skip(16000).as_numpy_iterator()
 
-    transformer = Transformer(input_vocab_size=input_vocab_size,
-                              target_vocab_size=target_vocab_size,
-                              pe_input=input_vocab_size,
-                              pe_target=target_vocab_size,
-                              hparams=hparams)
+    transformer = create_transformer(input_vocab_size=input_vocab_size,
+                                     target_vocab_size=target_vocab_size,
+                                     pe_input=input_vocab_size,
+                                     pe_target=target_vocab_size,
+                                     hparams=hparams)
 
 
     trainer = Trainer(dataset, hparams)
@@ -39,19 +39,36 @@ def generate(hparams):
 
     return generate_from_model(hparams, transformer, dataset_single)
 
+def seed_priors(prior, n, vocab_size):
+    """
+    Creates a batch of n priors from a single prior. The first one is the
+    prior itself, the others are perturbed with uniform noise in [-4, 4) to
+    give different continuations.
+    """
+    priors = tf.tile(tf.expand_dims(prior, 0), [n, 1])
+    noise = tf.random.uniform(priors.shape, -4, 4, dtype=priors.dtype)
+    noise = tf.concat([tf.zeros_like(noise[:1]), noise[1:]], 0)
+    return tf.clip_by_value(priors + noise, 0, vocab_size-1)
+
 def generate_from_model(hparams, transformer, priors):
-    outputs = []
-    prior_buf = []
+    """
+    Generates gen_iters continuations of the next prior from priors as one
+    batch, see seed_priors, and returns them concatenated, with the prior.
+    The continuations are independent, each starts from the (perturbed)
+    prior. They used to be chained, each continuing the perturbed output of
+    the previous one, which can't run as a batch.
+    """
     gen_iters = hparams['gen_iters'] if 'gen_iters' in hparams else 1
     prior = np.array(next(priors))
-    output = prior
-    for i in range(gen_iters):
-        print(f"Generating {i+1}/{gen_iters} sample...")
-        output, _ = transformer.evaluate(output)
-        outputs.append(output)
-        output = output + tf.random.uniform(output.shape, -4, 4, dtype=tf.int32)
-
-    encoded = tf.concat(outputs, 0)
+    print(f"Generating {gen_iters} samples...")
+    outputs, _ = transformer.generate(seed_priors(prior, gen_iters, transformer.target_vocab_size))
+
+    if 'stop_token' in hparams:
+        # Drop the padding after the stop token of each sequence
+        outputs = [output[:np.argmax(output == hparams['stop_token'])+1] if hparams['stop_token'] in output else output
+                   for output in outputs.numpy()]
+
+    encoded = tf.concat(list(outputs), 0)
     prior = tf.concat(prior, 0)
     return encoded, prior
 
@@ -2,6 +2,8 @@ import tensorflow as tf
 import tensorflow.keras as tfk
 from tensorflow.keras import layers as tfkl
 import numpy as np
+from models.transformer.mask import create_look_ahead_mask
+from models.common.precision import compute_dtype
 
 class PositionalEncoding(tfkl.Layer):
     def __init__(self, position, d_model):
@@ -17,9 +19,9 @@ class PositionalEncoding(tfkl.Layer):
         self.pos_enc = a[np.newaxis, ...]
         self.pos_enc = tf.cast(self.pos_enc, dtype=tf.float32)
 
-    def call(self, x):
+    def call(self, x, offset=0):
         seq_len = tf.shape(x)[1]
-        return x + self.pos_enc[:, :seq_len, :]
+        return x + tf.cast(self.pos_enc[:, offset:offset+seq_len, :], x.dtype)
 
     def get_angles(self, pos, i, d_model):
         w = 1.0 / np.power(10000, (2*(i//2)) / np.float32(d_model))
@@ -32,49 +34,84 @@ class ScaledAttention(tfkl.Layer):
     def call(self, q, k, v, mask):
         qk = tf.matmul(q, k, transpose_b=True)
 
+        # The masking and softmax are done in float32 with mixed precision
         dk = tf.cast(tf.shape(k)[-1], tf.float32)
-        attention_logits = qk / tf.math.sqrt(dk)
+        attention_logits = tf.cast(qk, tf.float32) / tf.math.sqrt(dk)
 
         if mask is not None:
             attention_logits += (mask * -1e9)
 
         weights = tf.nn.softmax(attention_logits, axis=-1)
 
-        outputs = tf.matmul(weights, v)
+        if mask is not None:
+            # See RelativeAttention
+            weights *= 1 - tf.reduce_min(mask, axis=-1, keepdims=True)
+
+        outputs = tf.matmul(tf.cast(weights, v.dtype), v)
 
         return outputs, weights
 
 class RelativeAttention(tfkl.Layer):
-    def __init__(self, max_seq, depth):
+    def __init__(self, max_seq, depth, causal=False, block_size=0, window=0):
         super(RelativeAttention, self).__init__()
         self.max_seq = max_seq
         self.depth = depth
+        self.causal = causal
+        self.block_size = block_size
+        # If set, queries only attend to keys less than window positions
+        # away. This always runs blockwise, with window sized blocks.
+        self.window = window
+        if window:
+            self.block_size = window
         self.e = None
 
     def build(self, input_shape):
         self.e = self.add_weight('embedding', shape=[self.max_seq, self.depth])
 
-    def call(self, q, k, v, mask):
-        k_len = k.shape[2]
-        q_len = q.shape[2]
+    def call(self, q, k, v, mask, pos=None):
+        if pos is None and self.block_size:
+            return self.blockwise(q, k, v, mask), None
+
+        if pos is None:
+            k_len = k.shape[2]
+            q_len = q.shape[2]
+
+            e = tf.cast(self.left_embedding(q_len, k_len), q.dtype)
+            qe = tf.einsum('bhld,md->bhlm', q, e)
+            qe = self.qe_mask(qe)
+            s_rel = self.skew(qe, k_len, q_len)
+
+            if self.causal:
+                look_ahead_mask = create_look_ahead_mask(q_len)
+                mask = look_ahead_mask if mask is None else tf.maximum(mask, look_ahead_mask)
+        else:
+            # A single query at position pos, used for incremental decoding
+            s_rel = self.relative_logits(q, pos, tf.shape(k)[2])
+
+            if self.window:
+                far = tf.cast(tf.abs(pos - tf.range(tf.shape(k)[2])) >= self.window, tf.float32)
+                mask = far if mask is None else tf.maximum(mask, far)
 
-        e = self.left_embedding(q_len, k_len)
-        qe = tf.einsum('bhld,md->bhlm', q, e)
-        qe = self.qe_mask(qe)
         kt = tf.transpose(k, [0, 1, 3, 2])
         qkt = tf.matmul(q, kt)
-        s_rel = self.skew(qe, k_len, q_len)
 
+        # See ScaledAttention
         dk = tf.cast(tf.shape(k)[-1], tf.float32)
 
-        attention_logits = (qkt + s_rel) / tf.math.sqrt(dk)
+        attention_logits = tf.cast(qkt + s_rel, tf.float32) / tf.math.sqrt(dk)
 
         if mask is not None:
             attention_logits += (mask * -1e9)
 
         weights = tf.nn.softmax(attention_logits, axis=-1)
 
-        outputs = tf.matmul(weights, v)
+        if mask is not None:
+            # Queries that can't see any key, like left padding, would get
+            # the mean of all values. They get 0 instead, like in blockwise,
+            # which only sees some of the keys.
+            weights *= 1 - tf.reduce_min(mask, axis=-1, keepdims=True)
+
+        outputs = tf.matmul(tf.cast(weights, v.dtype), v)
 
         return outputs, weights
 
@@ -94,7 +131,7 @@ class RelativeAttention(tfkl.Layer):
         mask = tf.sequence_mask(tf.range(qe.shape[-1] -1, qe.shape[-1] - qe.shape[-2] -1, -1), qe.shape[-1])
 
         mask = tf.logical_not(mask)
-        mask = tf.cast(mask, dtype=tf.float32)
+        mask = tf.cast(mask, dtype=qe.dtype)
 
         return qe * mask
 
@@ -102,10 +139,157 @@ class RelativeAttention(tfkl.Layer):
         start = max(0, self.max_seq - q_len)
         return self.e[start:, :]
 
+    def relative_logits(self, q, pos, k_len):
+        """
+        The relative term for a query at position pos against the keys at
+        positions 0..k_len-1. This is the row of skew(qe) in call for that
+        query: key j gets the embedding for distance pos-j, and keys after
+        the query get 0.
+        """
+        distance = pos - tf.range(k_len)
+        e = tf.gather(tf.cast(self.e, q.dtype), tf.clip_by_value(self.max_seq - 1 - distance, 0, self.max_seq - 1))
+        rel = tf.einsum('bhld,kd->bhlk', q, e)
+        return rel * tf.cast(distance >= 0, rel.dtype)
+
+    def blockwise(self, q, k, v, mask):
+        """
+        Computes the same outputs as the dense path, block_size queries at a
+        time with an online softmax over blocks of block_size keys. Only the
+        logits of one block exist at a time and the blocks are recomputed
+        during backprop, so memory grows linearly with the sequence length.
+        mask must not have a query axis (like a padding mask), causal masking
+        is done per block. Queries that can't see any key get 0.
+        """
+        q_len = tf.shape(q)[2]
+        if mask is None:
+            mask = tf.zeros([tf.shape(k)[0], 1, 1, tf.shape(k)[2]])
+        e = tf.cast(self.e, q.dtype)
+
+        num_blocks = (q_len + self.block_size - 1) // self.block_size
+
+        # Queries and keys are padded to whole blocks, so that every block has
+        # the same static shape like XLA needs. The padded keys are masked.
+        k_len = tf.shape(k)[2]
+        k_pad = (k_len + self.block_size - 1) // self.block_size * self.block_size - k_len
+        q = tf.pad(q, [[0, 0], [0, 0], [0, num_blocks * self.block_size - q_len], [0, 0]])
+        k = tf.pad(k, [[0, 0], [0, 0], [0, k_pad], [0, 0]])
+        v = tf.pad(v, [[0, 0], [0, 0], [0, k_pad], [0, 0]])
+        mask = tf.pad(mask, [[0, 0], [0, 0], [0, 0], [0, k_pad]], constant_values=1)
+
+        def query_block(i, outputs):
+            q0 = i * self.block_size
+            block = tf.recompute_grad(lambda q, k, v, e: self.attend_block(q, k, v, e, mask, q0))
+            output = block(tf.slice(q, [0, 0, q0, 0], [-1, -1, self.block_size, -1]), k, v, e)
+            # TensorArray concatenates along the first axis
+            return i+1, outputs.write(i, tf.transpose(output, [2, 0, 1, 3]))
+
+        # XLA needs a bound on the iterations to differentiate the loops
+        outputs = tf.TensorArray(q.dtype, size=num_blocks)
+        _, outputs = tf.while_loop(lambda i, _: i < num_blocks, query_block, (0, outputs),
+                                   maximum_iterations=num_blocks)
+
+        return tf.transpose(outputs.concat()[:q_len], [1, 2, 0, 3])
+
+    def attend_block(self, q, k, v, e, mask, q0):
+        """
+        Attends with the queries at positions q0.. to all keys, one block of
+        keys at a time. The keys have to be padded to whole blocks.
+        """
+        q_len = tf.shape(q)[2]
+        k_len = tf.shape(k)[2]
+        dk = tf.cast(tf.shape(k)[-1], tf.float32)
 
-class MultiHeadAttention(tfkl.Layer):
+        first_block = 0
+        num_blocks = max_blocks = (k_len + self.block_size - 1) // self.block_size
+        if self.causal:
+            # The key blocks after the last query are masked out completely
+            num_blocks = tf.minimum(num_blocks, (q0 + q_len + self.block_size - 1) // self.block_size)
+        if self.window:
+            # And so are the ones outside of the windows of the queries
+            first_block = tf.maximum(0, q0 - self.window + 1) // self.block_size
+            num_blocks = tf.minimum(num_blocks, (q0 + q_len + self.window - 2) // self.block_size + 1)
+
+        def key_block(j, m, l, acc, masked):
+            k0 = j * self.block_size
+            k_block = tf.slice(k, [0, 0, k0, 0], [-1, -1, self.block_size, -1])
+            v_block = tf.slice(v, [0, 0, k0, 0], [-1, -1, self.block_size, -1])
+            block_len = self.block_size
+
+            qkt = tf.matmul(q, k_block, transpose_b=True)
+            s_rel = self.relative_block(q, e, q0, k0, block_len)
+
+            # The online softmax is done in float32, see ScaledAttention
+            attention_logits = tf.cast(qkt + s_rel, tf.float32) / tf.math.sqrt(dk)
+
+            block_mask = tf.slice(mask, [0, 0, 0, k0], [-1, -1, -1, self.block_size])
+            distance = (q0 + tf.range(q_len))[:, tf.newaxis] - (k0 + tf.range(block_len))
+            if self.causal:
+                block_mask = tf.maximum(block_mask, tf.cast(distance < 0, tf.float32))
+            if self.window:
+                block_mask = tf.maximum(block_mask, tf.cast(tf.abs(distance) >= self.window, tf.float32))
+            attention_logits += (block_mask * -1e9)
+            # Whether every key so far was masked
+            masked = tf.minimum(masked, tf.reduce_min(block_mask, axis=-1, keepdims=True))
+
+            m_block = tf.maximum(m, tf.reduce_max(attention_logits, axis=-1, keepdims=True))
+            p = tf.exp(attention_logits - m_block)
+            scale = tf.exp(m - m_block)
+
+            l = l * scale + tf.reduce_sum(p, axis=-1, keepdims=True)
+            acc = acc * scale + tf.cast(tf.matmul(tf.cast(p, v.dtype), v_block), tf.float32)
+
+            return j+1, m_block, l, acc, masked
+
+        shape = tf.shape(q)
+        m = tf.fill([shape[0], shape[1], q_len, 1], -np.inf)
+        l = tf.zeros_like(m)
+        acc = tf.zeros([shape[0], shape[1], q_len, tf.shape(v)[-1]])
+        masked = tf.ones_like(m)
+        _, _, l, acc, masked = tf.while_loop(lambda j, *_: j < num_blocks, key_block,
+                                             (first_block, m, l, acc, masked),
+                                             maximum_iterations=max_blocks)
+
+        # The queries that can't see any key only averaged over the blocks
+        # they were run on, see call
+        return tf.cast(acc / l * (1 - masked), q.dtype)
+
+    def relative_block(self, q, e, q0, k0, k_len):
+        """
+        The relative term for the queries at positions q0.. against the keys
+        at positions k0..k0+k_len-1, the same values as the corresponding
+        part of skew(qe) in call. Only the q_len+k_len-1 distances occurring
+        in the block are multiplied with the queries, as a band that is then
+        skewed into place.
+        """
+        q_len = tf.shape(q)[2]
+        band_len = q_len + k_len - 1
+
+        # Column c of the band is for the distance q0-k0+q_len-1-c
+        distance = q0 - k0 + q_len - 1 - tf.range(band_len)
+        e = tf.gather(e, tf.clip_by_value(self.max_seq - 1 - distance, 0, self.max_seq - 1))
+        band = tf.einsum('bhld,md->bhlm', q, e) * tf.cast(distance >= 0, q.dtype)
+
+        # Shifting row a left by q_len-1-a gives query a and key b the
+        # column for the distance (q0+a)-(k0+b)
+        shape = tf.shape(band)
+        band = tf.pad(band, [[0, 0], [0, 0], [0, 0], [0, 1]])
+        band = tf.reshape(band, [shape[0], shape[1], -1])
+        band = band[:, :, q_len-1:q_len-1+q_len*band_len]
+        band = tf.reshape(band, shape)
+
+        return band[:, :, :, :k_len]
+
+
+class FusedAttention(tfkl.Layer):
+    """
+    The projections shared by the attention blocks. Q, K and V come from a
+    single [d_model, 3, num_heads, depth] kernel, in one matmul for self
+    attention, and heads are split and merged by einsum without any
+    transposes. Subclasses implement attention(q, k, v, mask, pos) on the
+    projected heads.
+    """
     def __init__(self, d_model, num_heads):
-        super(MultiHeadAttention, self).__init__()
+        super(FusedAttention, self).__init__()
         self.d_model = d_model
         self.num_heads = num_heads
 
@@ -113,78 +297,140 @@ class MultiHeadAttention(tfkl.Layer):
 
         self.depth = self.d_model // self.num_heads
 
-        self.wv = tfkl.Dense(d_model)
-        self.wk = tfkl.Dense(d_model)
-        self.wq = tfkl.Dense(d_model)
+        # The same initialization as the Dense layers these replace. The
+        # weights are created here since the step methods do not go through
+        # __call__.
+        limit = np.sqrt(6 / (d_model + d_model))
+
+        self.qkv_kernel = self.add_weight('qkv_kernel', shape=[d_model, 3, num_heads, self.depth],
+                                          initializer=tfk.initializers.RandomUniform(-limit, limit))
+        self.qkv_bias = self.add_weight('qkv_bias', shape=[3, num_heads, self.depth], initializer='zeros')
+        self.output_kernel = self.add_weight('output_kernel', shape=[num_heads, self.depth, d_model],
+                                             initializer=tfk.initializers.RandomUniform(-limit, limit))
+        self.output_bias = self.add_weight('output_bias', shape=[d_model], initializer='zeros')
+
+    def call(self, v, k, q, mask, return_attention=False):
+        if q is k and k is v:
+            q, k, v = self.project(q, 0, 3)
+        else:
+            k, v = self.project_kv(v, k)
+            q, = self.project(q, 0, 1)
+
+        return self.attend_heads(q, k, v, mask, None, return_attention)
+
+    def project(self, x, start, end):
+        """
+        Projects x [batch, len, d_model] with the parts start..end of the QKV
+        kernel (0 for Q, 1 for K and 2 for V), each to [batch, heads, len,
+        depth].
+        """
+        x = tf.einsum('bld,dnhk->nbhlk', x, tf.cast(self.qkv_kernel[:, start:end], x.dtype))
+        x += tf.cast(self.qkv_bias[start:end, tf.newaxis, :, tf.newaxis, :], x.dtype)
+        return tf.unstack(x, num=end-start)
+
+    def project_kv(self, v, k):
+        """
+        Projects and splits the keys and values into heads. Split out from
+        call so that they can be cached during incremental decoding.
+        """
+        if v is k:
+            return self.project(k, 1, 3)
+
+        k, = self.project(k, 1, 2)
+        v, = self.project(v, 2, 3)
+        return k, v
+
+    def attend(self, q, k, v, mask, pos=None, return_attention=False):
+        """
+        Attends with q to keys and values from project_kv. If pos is given q
+        is a single query at that position.
+        """
+        q, = self.project(q, 0, 1)
+        return self.attend_heads(q, k, v, mask, pos, return_attention)
+
+    def attend_heads(self, q, k, v, mask, pos, return_attention):
+        attention, attention_weights = self.attention(q, k, v, mask, pos)
+
+        output = tf.einsum('bhlk,hkd->bld', attention, tf.cast(self.output_kernel, attention.dtype))
+        output += tf.cast(self.output_bias, output.dtype)
+
+        return output, attention_weights if return_attention else None
+
+
+class MultiHeadAttention(FusedAttention):
+    def __init__(self, d_model, num_heads, causal=False):
+        super(MultiHeadAttention, self).__init__(d_model, num_heads)
+        self.causal = causal
 
         self.scaled_attention = ScaledAttention()
 
-        self.dense = tfkl.Dense(d_model)
-
-    def split_heads(self, x, batch_size):
-        x = tf.reshape(x, [batch_size, -1, self.num_heads, self.depth])
-        return tf.transpose(x, perm=[0, 2, 1, 3])
-
-    def call(self, v, k, q, mask):
-        batch_size = tf.shape(q)[0]
-
-        v = self.wv(v)
-        k = self.wk(k)
-        q = self.wq(q)
-
-        v = self.split_heads(v, batch_size)
-        k = self.split_heads(k, batch_size)
-        q = self.split_heads(q, batch_size)
-
-        attention, attention_weights = self.scaled_attention(q, k, v, mask)
-
-        attention = tf.transpose(attention, perm=[0, 2, 1, 3])
-        attention = tf.reshape(attention, [batch_size, -1, self.d_model])
-        output = self.dense(attention)
-
-        return output, attention_weights
-
-
-class RelativeGlobalAttention(tfkl.Layer):
-    def __init__(self, d_model, num_heads, max_seq):
-        super(RelativeGlobalAttention, self).__init__()
-        self.d_model = d_model
-        self.num_heads = num_heads
-
-        assert self.d_model % self.num_heads == 0, "d_model is not divisible by num_heads"
-
-        self.depth = self.d_model // self.num_heads
-
-        self.wv = tfkl.Dense(d_model)
-        self.wk = tfkl.Dense(d_model)
-        self.wq = tfkl.Dense(d_model)
-
-        self.relative_attention = RelativeAttention(max_seq, self.depth)
-
-        self.dense = tfkl.Dense(d_model)
-
-    def split_heads(self, x, batch_size):
-        x = tf.reshape(x, [batch_size, -1, self.num_heads, self.depth])
-        return tf.transpose(x, perm=[0, 2, 1, 3])
-
-    def call(self, v, k, q, mask):
-        batch_size = tf.shape(q)[0]
-
-        v = self.wv(v)
-        k = self.wk(k)
-        q = self.wq(q)
-
-        v = self.split_heads(v, batch_size)
-        k = self.split_heads(k, batch_size)
-        q = self.split_heads(q, batch_size)
-
-        attention, attention_weights = self.relative_attention(q, k, v, mask)
-
-        attention = tf.transpose(attention, perm=[0, 2, 1, 3])
-        attention = tf.reshape(attention, [batch_size, -1, self.d_model])
-        output = self.dense(attention)
-
-        return output, attention_weights
+    def attention(self, q, k, v, mask, pos):
+        # Positions do not matter here, so with pos the mask alone decides
+        # which keys the query sees
+        if self.causal and pos is None:
+            look_ahead_mask = create_look_ahead_mask(tf.shape(q)[2])
+            mask = look_ahead_mask if mask is None else tf.maximum(mask, look_ahead_mask)
+
+        return self.scaled_attention(q, k, v, mask)
+
+
+class RelativeGlobalAttention(FusedAttention):
+    def __init__(self, d_model, num_heads, max_seq, causal=False, block_size=0, window=0):
+        super(RelativeGlobalAttention, self).__init__(d_model, num_heads)
+
+        self.relative_attention = RelativeAttention(max_seq, self.depth, causal, block_size, window)
+
+    def attention(self, q, k, v, mask, pos):
+        return self.relative_attention(q, k, v, mask, pos=pos)
+
+
+def create_attention(kind, d_model, num_heads, max_seq, causal=False, block_size=0, window=0):
+    """
+    Creates an attention block of the given kind: 'relative' for global
+    relative attention, 'dot' for plain scaled dot-product attention or
+    'local' for relative attention limited to keys less than window
+    positions away, which takes linear time and memory.
+    """
+    if kind == 'relative':
+        return RelativeGlobalAttention(d_model, num_heads, max_seq, causal, block_size)
+    elif kind == 'dot':
+        return MultiHeadAttention(d_model, num_heads, causal)
+    elif kind == 'local':
+        # Only the relative positions within the window are needed
+        return RelativeGlobalAttention(d_model, num_heads, window, causal, window=window)
+    else:
+        raise Exception(f"No attention type named '{kind}'.")
+
+
+def new_seed():
+    return tf.random.uniform([2], maxval=tf.int32.max, dtype=tf.int32)
+
+def dropout(layer, x, training, seed=None, offset=0):
+    """
+    Applies the Dropout layer, or if a seed is given, the same dropout as a
+    function of seed+offset, so that it drops the same units when it is
+    recomputed.
+    """
+    if seed is None or not training:
+        return layer(x, training=training)
+
+    keep = tf.random.stateless_uniform(tf.shape(x), seed + [0, offset]) >= layer.rate
+    return x * tf.cast(keep, x.dtype) / (1 - layer.rate)
+
+def layer_norm(layer, x):
+    """
+    Applies a float32 LayerNormalization layer, returning the result in the
+    dtype of x.
+    """
+    return tf.cast(layer(x), x.dtype)
+
+def write_cache(cache, k, v, pos):
+    """
+    Writes the keys and values of position pos into the fixed size buffers
+    of a layer cache.
+    """
+    write = tf.equal(tf.range(tf.shape(cache['k'])[2]), pos)[:, tf.newaxis]
+    return { **cache, 'k': tf.where(write, k, cache['k']), 'v': tf.where(write, v, cache['v']) }
 
 
 class PointWiseFF(tfkl.Layer):
@@ -200,119 +446,268 @@ class PointWiseFF(tfkl.Layer):
 
 
 class EncoderLayer(tfkl.Layer):
-    def __init__(self, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, max_seq=2048, block_size=0, attention='relative', window=0,
+                 causal=False):
         super(EncoderLayer, self).__init__()
 
-        # self.mha = MultiHeadAttention(d_model, num_heads)
-        self.rga = RelativeGlobalAttention(d_model, num_heads, max_seq=2048) # TODO: remove max_seq hardcoding
+        # Named rga regardless of the attention type, to keep checkpoints
+        # of the relative attention models loading
+        self.rga = create_attention(attention, d_model, num_heads, max_seq, causal, block_size, window)
         self.pwff = PointWiseFF(d_model, dff)
 
-        self.lnorm1 = tfkl.LayerNormalization(epsilon=1e-6)
-        self.lnorm2 = tfkl.LayerNormalization(epsilon=1e-6)
+        self.lnorm1 = tfkl.LayerNormalization(epsilon=1e-6, dtype='float32')
+        self.lnorm2 = tfkl.LayerNormalization(epsilon=1e-6, dtype='float32')
 
         self.dropout1 = tfkl.Dropout(rate)
         self.dropout2 = tfkl.Dropout(rate)
 
-    def call(self, x, training, mask):
+    def call(self, x, training, mask, seed=None):
         attn_output, _ = self.rga(x, x, x, mask)
-        attn_output = self.dropout1(attn_output, training=training)
+        attn_output = dropout(self.dropout1, attn_output, training, seed, 1)
 
-        out1 = self.lnorm1(x + attn_output)
+        out1 = layer_norm(self.lnorm1, x + attn_output)
 
         ffn_output = self.pwff(out1)
-        ffn_output = self.dropout2(ffn_output, training=training)
+        ffn_output = dropout(self.dropout2, ffn_output, training, seed, 2)
 
-        out2 = self.lnorm2(out1 + ffn_output)
+        out2 = layer_norm(self.lnorm2, out1 + ffn_output)
 
         return out2
 
+    def prefill(self, x, length, mask):
+        """
+        Runs the layer like call during inference, also returning a cache
+        for step with room for length positions, holding the keys and
+        values of x. Only meaningful for causal layers.
+        """
+        q, k, v = self.rga.project(x, 0, 3)
+
+        attn_output, _ = self.rga.attend_heads(q, k, v, mask, None, False)
+        out1 = layer_norm(self.lnorm1, x + attn_output)
+
+        ffn_output = self.pwff(out1)
+        out2 = layer_norm(self.lnorm2, out1 + ffn_output)
+
+        padding = [[0, 0], [0, 0], [0, length - tf.shape(k)[2]], [0, 0]]
+        return out2, {'k': tf.pad(k, padding), 'v': tf.pad(v, padding)}
+
+    def step(self, x, cache, pos, mask):
+        """
+        Runs a causal layer for the single new position pos, see
+        DecoderLayer.step.
+        """
+        cache = write_cache(cache, *self.rga.project_kv(x, x), pos)
+
+        attn_output, _ = self.rga.attend(x, cache['k'], cache['v'], mask, pos)
+        out1 = layer_norm(self.lnorm1, x + attn_output)
+
+        ffn_output = self.pwff(out1)
+        out2 = layer_norm(self.lnorm2, out1 + ffn_output)
+
+        return out2, cache
+
 
 class DecoderLayer(tfkl.Layer):
-    def __init__(self, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, max_seq=2048, block_size=0,
+                 self_attention='relative', cross_attention='relative', window=0):
         super(DecoderLayer, self).__init__()
 
-        # self.mha1 = MultiHeadAttention(d_model, num_heads)
-        # self.mha2 = MultiHeadAttention(d_model, num_heads)
-        self.rga1 = RelativeGlobalAttention(d_model, num_heads, max_seq=2048) # TODO: remove max_seq hardcoding
-        self.rga2 = RelativeGlobalAttention(d_model, num_heads, max_seq=2048) # TODO: remove max_seq hardcoding
+        # See EncoderLayer for the names
+        self.rga1 = create_attention(self_attention, d_model, num_heads, max_seq, causal=True, block_size=block_size, window=window)
+        self.rga2 = create_attention(cross_attention, d_model, num_heads, max_seq, block_size=block_size, window=window)
 
         self.pwff = PointWiseFF(d_model, dff)
 
-        self.lnorm1 = tfkl.LayerNormalization(epsilon=1e-6)
-        self.lnorm2 = tfkl.LayerNormalization(epsilon=1e-6)
-        self.lnorm3 = tfkl.LayerNormalization(epsilon=1e-6)
+        self.lnorm1 = tfkl.LayerNormalization(epsilon=1e-6, dtype='float32')
+        self.lnorm2 = tfkl.LayerNormalization(epsilon=1e-6, dtype='float32')
+        self.lnorm3 = tfkl.LayerNormalization(epsilon=1e-6, dtype='float32')
 
         self.dropout1 = tfkl.Dropout(rate)
         self.dropout2 = tfkl.Dropout(rate)
         self.dropout3 = tfkl.Dropout(rate)
 
-    def call(self, x, enc_output, training, look_ahead_mask, padding_mask):
-        attn1, attn_weights_block1 = self.rga1(x, x, x, look_ahead_mask)
-        attn1 = self.dropout1(attn1, training=training)
-        out1 = self.lnorm1(attn1 + x)
+    def call(self, x, enc_output, training, look_ahead_mask, padding_mask, return_attention=False, seed=None):
+        attn1, attn_weights_block1 = self.rga1(x, x, x, look_ahead_mask, return_attention)
+        attn1 = dropout(self.dropout1, attn1, training, seed, 1)
+        out1 = layer_norm(self.lnorm1, attn1 + x)
 
-        attn2, attn_weights_block2 = self.rga2(enc_output, enc_output, out1, padding_mask)
-        attn2 = self.dropout2(attn2, training=training)
-        out2 = self.lnorm2(attn2 + out1)
+        attn2, attn_weights_block2 = self.rga2(enc_output, enc_output, out1, padding_mask, return_attention)
+        attn2 = dropout(self.dropout2, attn2, training, seed, 2)
+        out2 = layer_norm(self.lnorm2, attn2 + out1)
 
         ffn_output = self.pwff(out2)
-        ffn_output = self.dropout3(ffn_output, training=training)
-        out3 = self.lnorm3(ffn_output + out2)
+        ffn_output = dropout(self.dropout3, ffn_output, training, seed, 3)
+        out3 = layer_norm(self.lnorm3, ffn_output + out2)
 
         return out3, attn_weights_block1, attn_weights_block2
 
+    def step(self, x, cache, pos, look_ahead_mask, padding_mask, return_attention=False):
+        """
+        Runs the layer for a single new position pos during inference. cache
+        holds fixed size buffers with the projected keys and values of every
+        position ('k' and 'v', written up to pos) and the projected encoder
+        output ('enc_k' and 'enc_v'). Positions after pos must be masked by
+        look_ahead_mask. The updated cache is returned.
+        """
+        cache = write_cache(cache, *self.rga1.project_kv(x, x), pos)
+
+        attn1, attn_weights_block1 = self.rga1.attend(x, cache['k'], cache['v'], look_ahead_mask, pos, return_attention)
+        out1 = layer_norm(self.lnorm1, attn1 + x)
+
+        attn2, attn_weights_block2 = self.rga2.attend(out1, cache['enc_k'], cache['enc_v'], padding_mask, pos, return_attention)
+        out2 = layer_norm(self.lnorm2, attn2 + out1)
+
+        ffn_output = self.pwff(out2)
+        out3 = layer_norm(self.lnorm3, ffn_output + out2)
+
+        return out3, attn_weights_block1, attn_weights_block2, cache
+
 class Encoder(tfkl.Layer):
-    def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, max_pos_enc, rate=0.1):
+    def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, max_seq, rate=0.1, block_size=0,
+                 attention='relative', window=0, causal=False, remat=False):
         super(Encoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
+        # If set, only the layer inputs are kept for backprop during training
+        # and everything inside the layers is recomputed
+        self.remat = remat
 
         self.embedding = tfkl.Embedding(input_vocab_size, d_model)
-        self.pos_enc = PositionalEncoding(2048, self.d_model)
+        self.pos_enc = PositionalEncoding(max_seq, self.d_model)
 
-        self.layers = [EncoderLayer(d_model, num_heads, dff, rate) for _ in range(num_layers)]
+        self.layers = [EncoderLayer(d_model, num_heads, dff, rate, max_seq, block_size, attention, window, causal)
+                       for _ in range(num_layers)]
 
         self.dropout = tfkl.Dropout(rate)
 
     def call(self, x, training, mask):
-        x = self.embedding(x)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+        x = tf.cast(self.embedding(x), compute_dtype())
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
         x = self.pos_enc(x)
 
         x = self.dropout(x, training=training)
 
         for i in range(self.num_layers):
-            x = self.layers[i](x, training, mask)
+            if self.remat and training:
+                # The layer and seed are bound now, the recomputation only
+                # runs in the backward pass, after the loop
+                x = tf.recompute_grad(lambda x, layer=self.layers[i], seed=new_seed():
+                                      layer(x, training, mask, seed=seed))(x)
+            else:
+                x = self.layers[i](x, training, mask)
 
         return x
 
+    def prefill(self, x, length, mask):
+        """
+        Runs a causal encoder over x during inference, returning the output
+        and the caches used by step for continuing up to length positions.
+        """
+        x = tf.cast(self.embedding(x), compute_dtype())
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
+        x = self.pos_enc(x)
+
+        caches = []
+        for i in range(self.num_layers):
+            x, cache = self.layers[i].prefill(x, length, mask)
+            caches.append(cache)
+
+        return x, caches
+
+    def step(self, x, caches, pos, mask):
+        """
+        Runs a causal encoder for the single position pos, given the caches
+        from prefill or the previous step. Returns the output and the
+        updated caches.
+        """
+        x = tf.cast(self.embedding(x), compute_dtype())
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
+        x = self.pos_enc(x, offset=pos)
+
+        new_caches = []
+        for i in range(self.num_layers):
+            x, cache = self.layers[i].step(x, caches[i], pos, mask)
+            new_caches.append(cache)
+
+        return x, new_caches
+
 class Decoder(tfkl.Layer):
-    def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, max_pos_enc, rate=0.1):
+    def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, max_seq, rate=0.1, block_size=0,
+                 self_attention='relative', cross_attention='relative', window=0, remat=False):
         super(Decoder, self).__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
+        # See Encoder
+        self.remat = remat
 
         self.embedding = tfkl.Embedding(target_vocab_size, d_model)
-        self.pos_enc = PositionalEncoding(2048, self.d_model)
+        self.pos_enc = PositionalEncoding(max_seq, self.d_model)
 
-        self.layers = [DecoderLayer(d_model, num_heads, dff, rate) for _ in range(num_layers)]
+        self.layers = [DecoderLayer(d_model, num_heads, dff, rate, max_seq, block_size,
+                                    self_attention, cross_attention, window)
+                       for _ in range(num_layers)]
 
         self.dropout = tfkl.Dropout(rate)
 
-    def call(self, x, enc_output, training, look_ahead_mask, padding_mask):
+    def call(self, x, enc_output, training, look_ahead_mask, padding_mask, return_attention=False):
+        """
+        Returns the output and, if return_attention is set, the attention
+        weights of every block (None otherwise).
+        """
         attention_weights = {}
 
-        x = self.embedding(x)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+        x = tf.cast(self.embedding(x), compute_dtype())
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
         x = self.pos_enc(x)
 
         x = self.dropout(x, training=training)
 
         for i in range(self.num_layers):
-            x, block1, block2 = self.layers[i](x, enc_output, training, look_ahead_mask, padding_mask)
+            if self.remat and training and not return_attention:
+                # See Encoder.call
+                x = tf.recompute_grad(lambda x, enc_output, layer=self.layers[i], seed=new_seed():
+                                      layer(x, enc_output, training, look_ahead_mask, padding_mask, seed=seed)[0])(x, enc_output)
+                block1 = block2 = None
+            else:
+                x, block1, block2 = self.layers[i](x, enc_output, training, look_ahead_mask, padding_mask, return_attention)
+            attention_weights['dec_l{}_b1'.format(i+1)] = block1
+            attention_weights['dec_l{}_b2'.format(i+1)] = block2
+
+        return x, attention_weights if return_attention else None
+
+    def init_cache(self, enc_output, length):
+        """
+        Creates the caches used by step for decoding up to length positions.
+        """
+        batch_size = tf.shape(enc_output)[0]
+        caches = []
+        for layer in self.layers:
+            enc_k, enc_v = layer.rga2.project_kv(enc_output, enc_output)
+            empty = tf.zeros([batch_size, layer.rga1.num_heads, length, layer.rga1.depth], dtype=enc_k.dtype)
+            caches.append({'k': empty, 'v': empty, 'enc_k': enc_k, 'enc_v': enc_v})
+        return caches
+
+    def step(self, x, caches, pos, look_ahead_mask, padding_mask, return_attention=False):
+        """
+        Decodes the single position pos, given the caches from init_cache or
+        the previous step. Returns the output, the attention weights of the
+        position (None unless return_attention is set) and the updated
+        caches.
+        """
+        attention_weights = {}
+
+        x = tf.cast(self.embedding(x), compute_dtype())
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
+        x = self.pos_enc(x, offset=pos)
+
+        new_caches = []
+        for i in range(self.num_layers):
+            x, block1, block2, cache = self.layers[i].step(x, caches[i], pos, look_ahead_mask, padding_mask,
+                                                           return_attention)
+            new_caches.append(cache)
             attention_weights['dec_l{}_b1'.format(i+1)] = block1
             attention_weights['dec_l{}_b2'.format(i+1)] = block2
 
-        return x, attention_weights
+        return x, attention_weights if return_attention else None, new_caches
@@ -2,69 +2,145 @@ import tensorflow as tf
 import tensorflow.keras as tfk
 from tensorflow.keras import layers as tfkl
 from models.transformer.layers import Encoder, Decoder
-from models.transformer.mask import create_padding_mask, create_look_ahead_mask
+from models.transformer.mask import create_padding_mask
 from models.transformer.optimizer import TransformerLRSchedule
-
+import models.common.precision as precision
+import models.common.distribute as distribute
+
+
+def create_optimizer(hparams):
+    return tfk.optimizers.Adam(hparams['lr'] if 'lr' in hparams else TransformerLRSchedule(hparams['d_model']),
+                               beta_1=hparams['beta_1'],
+                               beta_2=hparams['beta_2'],
+                               epsilon=hparams['epsilon'])
+
+def create_transformer(input_vocab_size, target_vocab_size, pe_input, pe_target, hparams):
+    """
+    Creates the model selected by the architecture hparam, 'encoder_decoder'
+    (the default) for Transformer or 'decoder_only' for
+    DecoderOnlyTransformer.
+    """
+    architecture = hparams['architecture'] if 'architecture' in hparams else 'encoder_decoder'
+    if architecture == 'encoder_decoder':
+        return Transformer(input_vocab_size, target_vocab_size, pe_input, pe_target, hparams)
+    elif architecture == 'decoder_only':
+        return DecoderOnlyTransformer(target_vocab_size, hparams)
+    else:
+        raise Exception(f"No architecture named '{architecture}'.")
 
 class Transformer(tfk.Model):
     def __init__(self, input_vocab_size, target_vocab_size, pe_input, pe_target, hparams):
         super(Transformer, self).__init__()
         self.hparams = hparams
+        self.target_vocab_size = target_vocab_size
+
+        # The longest sequence that the positional encoding and the relative
+        # attention embeddings cover
+        max_seq = hparams['max_seq'] if 'max_seq' in hparams else 2048
+        # If set, attention is computed in blocks of this many positions
+        block_size = hparams['attention_block_size'] if 'attention_block_size' in hparams else 0
+        # The attention type of each kind of block, see create_attention
+        encoder_attention = hparams['encoder_attention'] if 'encoder_attention' in hparams else 'relative'
+        decoder_attention = hparams['decoder_attention'] if 'decoder_attention' in hparams else 'relative'
+        cross_attention = hparams['cross_attention'] if 'cross_attention' in hparams else 'relative'
+        window = hparams['local_window'] if 'local_window' in hparams else 0
+        # Recompute the layer activations during backprop, see Encoder
+        remat = hparams['remat'] if 'remat' in hparams else False
 
         self.encoder = Encoder(hparams['num_layers'],
                                hparams['d_model'],
                                hparams['num_heads'],
                                hparams['dff'],
                                input_vocab_size,
-                               pe_input,
-                               hparams['dropout_rate'])
+                               max_seq,
+                               hparams['dropout_rate'],
+                               block_size,
+                               encoder_attention,
+                               window,
+                               remat=remat)
 
         self.decoder = Decoder(hparams['num_layers'],
                                hparams['d_model'],
                                hparams['num_heads'],
                                hparams['dff'],
                                target_vocab_size,
-                               pe_target,
-                               hparams['dropout_rate'])
+                               max_seq,
+                               hparams['dropout_rate'],
+                               block_size,
+                               decoder_attention,
+                               cross_attention,
+                               window,
+                               remat)
 
-        self.final_layer = tfkl.Dense(target_vocab_size)
+        # The logits and the loss are computed in float32
+        self.final_layer = tfkl.Dense(target_vocab_size, dtype='float32')
 
         self.loss_obj = tfk.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
 
-        self.optimizer = tfk.optimizers.Adam(hparams['lr'] if 'lr' in hparams else TransformerLRSchedule(hparams['d_model']),
-                                             beta_1=hparams['beta_1'],
-                                             beta_2=hparams['beta_2'],
-                                             epsilon=hparams['epsilon'])
+        self.optimizer = create_optimizer(hparams)
+        self.train_optimizer = precision.loss_scale_optimizer(self.optimizer)
 
-    def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask):
+    def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask, return_attention=False):
         eo = self.encoder(inp, training, enc_padding_mask)
 
-        do, attention_weights = self.decoder(tar, eo, training, look_ahead_mask, dec_padding_mask)
+        do, attention_weights = self.decoder(tar, eo, training, look_ahead_mask, dec_padding_mask, return_attention)
 
         fo = self.final_layer(do)
 
         return fo, attention_weights
 
+    def create_weights(self):
+        """
+        Creates all weights with a forward pass on a dummy batch. The weights
+        can not be created inside the layers recomputed with remat, so this
+        has to run before the first train_step.
+        """
+        x = tf.ones([1, 1], dtype=tf.int64)
+        self.call(x, x, False, None, None, None)
+
     @tf.function
     def train_step(self, x):
+        gradients, stats = self.compute_gradients(x)
+        self.apply_gradients(gradients)
+        return stats
+
+    def compute_gradients(self, x):
+        """
+        The gradients of the loss on x, in the same structure as
+        train_variables, and the stats returned by train_step.
+        """
         inp, tar = x
         tar_inp = tar[:, :-1]
         tar_real = tar[:, 1:]
 
-        enc_padding_mask, combined_mask, dec_padding_mask = self.create_masks(inp, tar_inp)
+        enc_padding_mask, dec_target_padding_mask, dec_padding_mask = self.create_masks(inp, tar_inp)
 
         with tf.GradientTape() as tape:
             predictions, _ = self.call(inp, tar_inp,
                                        True,
                                        enc_padding_mask,
-                                       combined_mask,
+                                       dec_target_padding_mask,
                                        dec_padding_mask)
             loss = self.loss_function(tar_real, predictions)
+            scaled_loss = precision.scale_loss(self.train_optimizer, distribute.replica_loss(loss))
+
+        gradients = tape.gradient(scaled_loss, self.trainable_variables)
+        gradients = precision.unscale_gradients(self.train_optimizer, gradients)
 
-        gradients = tape.gradient(loss, self.trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return gradients, {'loss': loss, 'accuracy': self.accuracy_function(tar_real, predictions)}
 
-        return loss, tar_real, predictions
+    def apply_gradients(self, gradients):
+        self.train_optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+
+    def train_variables(self):
+        return self.trainable_variables
+
+    def count_tokens(self, x):
+        """
+        The number of tokens in the batch x, padding excluded.
+        """
+        inp, tar = x
+        return tf.math.count_nonzero(inp) + tf.math.count_nonzero(tar)
 
 
     def loss_function(self, real, pred):
@@ -76,17 +152,110 @@ class Transformer(tfk.Model):
 
         return tf.reduce_mean(loss)
 
+    def accuracy_function(self, real, pred):
+        """
+        The same as tf.keras.metrics.SparseCategoricalAccuracy for a single
+        batch, padding included.
+        """
+        return tf.reduce_mean(tf.cast(tf.equal(real, tf.argmax(pred, axis=-1, output_type=real.dtype)), tf.float32))
+
     def create_masks(self, inp, tar):
         enc_padding_mask = create_padding_mask(inp)
         dec_padding_mask = create_padding_mask(inp)
 
-        look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
+        # The decoder self attention adds the look ahead mask itself
         dec_target_padding_mask = create_padding_mask(tar)
-        combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
 
-        return enc_padding_mask, combined_mask, dec_padding_mask
+        return enc_padding_mask, dec_target_padding_mask, dec_padding_mask
 
-    def evaluate(self, inp_sentence):
+    def evaluate(self, inp_sentence, incremental=True):
+        """
+        Greedily generates frame_size tokens following the prior
+        inp_sentence. By default this runs generate, the incremental=False
+        path reruns the whole model for every token.
+        """
+        if not incremental:
+            return self.evaluate_full(inp_sentence)
+
+        output, attention_weights = self.generate(tf.expand_dims(inp_sentence, 0), True)
+        return tf.squeeze(output, axis=0), attention_weights
+
+    @tf.function
+    def generate(self, priors, return_attention=False):
+        """
+        Greedily generates frame_size tokens following each of the priors
+        [batch, prior_len] as a single compiled loop. The priors are encoded
+        once and the decoder runs one position at a time for the whole batch
+        on cached keys and values, writing into buffers preallocated for all
+        frame_size positions.
+
+        If the stop_token hparam is set, a sequence stops after generating
+        it and is padded with 0 from there on. The loop ends when every
+        sequence has stopped.
+
+        Returns the tokens [batch, frame_size+1], starting with the first
+        token of the prior like evaluate_full, and, if return_attention is
+        set, the attention weights of each decoder block as evaluate_full
+        would return them (None otherwise).
+        """
+        frame_size = self.hparams['frame_size']
+        stop_token = self.hparams['stop_token'] if 'stop_token' in self.hparams else None
+        batch_size = tf.shape(priors)[0]
+        positions = tf.range(frame_size + 1)
+
+        enc_padding_mask = create_padding_mask(priors)
+        enc_output = self.encoder(priors, False, enc_padding_mask)
+        caches = self.decoder.init_cache(enc_output, frame_size)
+
+        tokens = tf.pad(priors[:, :1], [[0, 0], [0, frame_size]])
+        done = tf.zeros([batch_size, 1], dtype=tf.bool)
+
+        attention_weights = {}
+        if return_attention:
+            num_heads = self.hparams['num_heads']
+            for i in range(self.hparams['num_layers']):
+                attention_weights['dec_l{}_b1'.format(i+1)] = tf.zeros([batch_size, num_heads, frame_size, frame_size])
+                attention_weights['dec_l{}_b2'.format(i+1)] = tf.zeros([batch_size, num_heads, frame_size, tf.shape(priors)[1]])
+
+        def step(i, tokens, done, caches, attention_weights):
+            # The positions after i are still 0 in the buffer, so the
+            # padding mask also hides them from position i
+            look_ahead_mask = create_padding_mask(tokens[:, :frame_size])
+
+            x, weights, caches = self.decoder.step(tokens[:, i:i+1],
+                                                   caches,
+                                                   i,
+                                                   look_ahead_mask,
+                                                   enc_padding_mask,
+                                                   return_attention)
+
+            predictions = self.final_layer(x)
+
+            predicted_id = tf.cast(tf.argmax(predictions[:, -1], axis=-1), tokens.dtype)[:, tf.newaxis]
+            predicted_id = tf.where(done, tf.zeros_like(predicted_id), predicted_id)
+
+            tokens = tf.where(tf.equal(positions, i+1), predicted_id, tokens)
+
+            if stop_token is not None:
+                done = tf.logical_or(done, tf.equal(predicted_id, stop_token))
+
+            if return_attention:
+                row = tf.equal(tf.range(frame_size), i)[:, tf.newaxis]
+                attention_weights = {key: tf.where(row, weights[key], w) for key, w in attention_weights.items()}
+
+            return i+1, tokens, done, caches, attention_weights
+
+        def cond(i, tokens, done, *_):
+            return tf.logical_and(i < frame_size, tf.logical_not(tf.reduce_all(done)))
+
+        # The first step is run outside of the loop so that any layers that
+        # are not built yet create their variables there
+        loop_vars = step(0, tokens, done, caches, attention_weights)
+        _, tokens, _, _, attention_weights = tf.while_loop(cond, step, loop_vars)
+
+        return tokens, attention_weights if return_attention else None
+
+    def evaluate_full(self, inp_sentence):
         encoder_input = tf.expand_dims(inp_sentence, 0)
 
         decoder_input = [inp_sentence[0]]
@@ -94,15 +263,16 @@ class Transformer(tfk.Model):
         output_tot = tf.expand_dims(decoder_input, 0)
 
         for i in range(self.hparams['frame_size']):
-            enc_padding_mask, combined_mask, dec_padding_mask = self.create_masks(
+            enc_padding_mask, dec_target_padding_mask, dec_padding_mask = self.create_masks(
                 encoder_input, output)
 
             predictions, attention_weights = self.call(encoder_input,
                                                        output,
                                                        False,
                                                        enc_padding_mask,
-                                                       combined_mask,
-                                                       dec_padding_mask)
+                                                       dec_target_padding_mask,
+                                                       dec_padding_mask,
+                                                       True)
 
             predictions = predictions[: ,-1:, :]
 
@@ -115,3 +285,165 @@ class Transformer(tfk.Model):
 
         return tf.squeeze(output, axis=0), attention_weights
 
+
+class DecoderOnlyTransformer(tfk.Model):
+    """
+    A single stack of causal self attention layers, trained to predict the
+    next token of the input and target frames as one contiguous sequence.
+    Has the same training and generation interface as Transformer, at about
+    half the cost per token.
+    """
+    def __init__(self, vocab_size, hparams):
+        super(DecoderOnlyTransformer, self).__init__()
+        self.hparams = hparams
+        self.target_vocab_size = vocab_size
+
+        max_seq = hparams['max_seq'] if 'max_seq' in hparams else 2048
+        block_size = hparams['attention_block_size'] if 'attention_block_size' in hparams else 0
+        attention = hparams['decoder_attention'] if 'decoder_attention' in hparams else 'relative'
+        window = hparams['local_window'] if 'local_window' in hparams else 0
+        remat = hparams['remat'] if 'remat' in hparams else False
+
+        self.decoder = Encoder(hparams['num_layers'],
+                               hparams['d_model'],
+                               hparams['num_heads'],
+                               hparams['dff'],
+                               vocab_size,
+                               max_seq,
+                               hparams['dropout_rate'],
+                               block_size,
+                               attention,
+                               window,
+                               causal=True,
+                               remat=remat)
+
+        self.final_layer = tfkl.Dense(vocab_size, dtype='float32')
+
+        self.loss_obj = tfk.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
+
+        self.optimizer = create_optimizer(hparams)
+        self.train_optimizer = precision.loss_scale_optimizer(self.optimizer)
+
+    def call(self, x, training, padding_mask):
+        return self.final_layer(self.decoder(x, training, padding_mask))
+
+    def create_weights(self):
+        """
+        See Transformer.create_weights.
+        """
+        x = tf.ones([1, 1], dtype=tf.int64)
+        self.call(x, False, None)
+
+    @tf.function
+    def train_step(self, x):
+        gradients, stats = self.compute_gradients(x)
+        self.apply_gradients(gradients)
+        return stats
+
+    def compute_gradients(self, x):
+        """
+        See Transformer.compute_gradients.
+        """
+        inp, tar = x
+        seq = tf.concat([inp, tar], axis=-1)
+        seq_inp = seq[:, :-1]
+        seq_real = seq[:, 1:]
+
+        padding_mask = create_padding_mask(seq_inp)
+
+        with tf.GradientTape() as tape:
+            predictions = self.call(seq_inp, True, padding_mask)
+            loss = self.loss_function(seq_real, predictions)
+            scaled_loss = precision.scale_loss(self.train_optimizer, distribute.replica_loss(loss))
+
+        gradients = tape.gradient(scaled_loss, self.trainable_variables)
+        gradients = precision.unscale_gradients(self.train_optimizer, gradients)
+
+        return gradients, {'loss': loss, 'accuracy': self.accuracy_function(seq_real, predictions)}
+
+    def apply_gradients(self, gradients):
+        self.train_optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+
+    def train_variables(self):
+        return self.trainable_variables
+
+    def count_tokens(self, x):
+        """
+        See Transformer.count_tokens.
+        """
+        inp, tar = x
+        return tf.math.count_nonzero(inp) + tf.math.count_nonzero(tar)
+
+    def loss_function(self, real, pred):
+        mask = tf.math.logical_not(tf.math.equal(real, 0))
+        loss = self.loss_obj(real, pred)
+
+        mask = tf.cast(mask, dtype=loss.dtype)
+        loss *= mask
+
+        return tf.reduce_mean(loss)
+
+    def accuracy_function(self, real, pred):
+        """
+        See Transformer.accuracy_function.
+        """
+        return tf.reduce_mean(tf.cast(tf.equal(real, tf.argmax(pred, axis=-1, output_type=real.dtype)), tf.float32))
+
+    def evaluate(self, inp_sentence):
+        """
+        Generates frame_size tokens following the prior inp_sentence, see
+        generate. No attention weights are collected.
+        """
+        output, _ = self.generate(tf.expand_dims(inp_sentence, 0))
+        return tf.squeeze(output, axis=0), None
+
+    @tf.function
+    def generate(self, priors, return_attention=False):
+        """
+        Greedily generates frame_size tokens following each of the priors
+        [batch, prior_len]. The priors are run through the model once,
+        filling the key and value caches, then the loop continues from
+        there one position at a time like Transformer.generate (including
+        stop_token).
+
+        Returns the tokens [batch, frame_size+1], starting with the last
+        token of the prior. return_attention is not supported.
+        """
+        assert not return_attention, "DecoderOnlyTransformer does not return attention weights"
+
+        frame_size = self.hparams['frame_size']
+        stop_token = self.hparams['stop_token'] if 'stop_token' in self.hparams else None
+        prior_len = tf.shape(priors)[1]
+        length = prior_len + frame_size
+        positions = tf.range(length)
+
+        tokens = tf.pad(priors, [[0, 0], [0, frame_size]])
+
+        x, caches = self.decoder.prefill(priors, length, create_padding_mask(priors))
+
+        def predict(x, tokens, done, pos):
+            predicted_id = tf.cast(tf.argmax(self.final_layer(x[:, -1]), axis=-1), tokens.dtype)[:, tf.newaxis]
+            predicted_id = tf.where(done, tf.zeros_like(predicted_id), predicted_id)
+
+            tokens = tf.where(tf.equal(positions, pos), predicted_id, tokens)
+
+            if stop_token is not None:
+                done = tf.logical_or(done, tf.equal(predicted_id, stop_token))
+
+            return tokens, done
+
+        tokens, done = predict(x, tokens, tf.zeros([tf.shape(priors)[0], 1], dtype=tf.bool), prior_len)
+
+        def step(pos, tokens, done, caches):
+            # The positions after pos are still 0 in the buffer, so the
+            # padding mask also hides them
+            x, caches = self.decoder.step(tokens[:, pos:pos+1], caches, pos, create_padding_mask(tokens))
+            tokens, done = predict(x, tokens, done, pos+1)
+            return pos+1, tokens, done, caches
+
+        def cond(pos, tokens, done, *_):
+            return tf.logical_and(pos < length - 1, tf.logical_not(tf.reduce_all(done)))
+
+        _, tokens, _, _ = tf.while_loop(cond, step, (prior_len, tokens, done, caches))
+
+        return tokens[:, prior_len-1:], None
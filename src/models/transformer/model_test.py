@@ -0,0 +1,173 @@
+import unittest
+import numpy as np
+import tensorflow as tf
+from models.transformer.model import create_transformer
+from models.transformer.mask import create_padding_mask
+
+class TestRemat(unittest.TestCase):
+
+    def gradients(self, architecture, remat, weights=None):
+        hparams = {
+            'architecture': architecture,
+            'num_layers': 3,
+            'd_model': 16,
+            'dff': 16,
+            'num_heads': 2,
+            'dropout_rate': 0.0,
+            'max_seq': 32,
+            'remat': remat,
+            'lr': 0.001,
+            'beta_1': 0.9,
+            'beta_2': 0.98,
+            'epsilon': 1e-9,
+        }
+        transformer = create_transformer(32, 32, 32, 32, hparams)
+        transformer.create_weights()
+        if weights is not None:
+            transformer.set_weights(weights)
+
+        x = np.random.RandomState(0).randint(1, 32, [2, 2, 8])
+        gradients, _ = transformer.compute_gradients((tf.constant(x[0]), tf.constant(x[1])))
+        return transformer.get_weights(), [v.name for v in transformer.trainable_variables], gradients
+
+    def assert_same_gradients(self, architecture):
+        weights, names, expected = self.gradients(architecture, False)
+        _, _, gradients = self.gradients(architecture, True, weights)
+
+        self.assertEqual(len(gradients), len(expected))
+        for name, gradient, e in zip(names, gradients, expected):
+            self.assertIsNotNone(gradient, name)
+            self.assertGreater(np.abs(tf.convert_to_tensor(gradient).numpy()).sum(), 0, name)
+            np.testing.assert_allclose(tf.convert_to_tensor(gradient).numpy(), tf.convert_to_tensor(e).numpy(),
+                                       rtol=1e-4, atol=1e-6, err_msg=name)
+
+    def test_remat_gradients_encoder_decoder(self):
+        self.assert_same_gradients('encoder_decoder')
+
+    def test_remat_gradients_decoder_only(self):
+        self.assert_same_gradients('decoder_only')
+
+class TestBlockwise(unittest.TestCase):
+
+    def loss_and_gradients(self, block_size, weights=None):
+        hparams = {
+            'architecture': 'decoder_only',
+            'num_layers': 2,
+            'd_model': 16,
+            'dff': 16,
+            'num_heads': 2,
+            'dropout_rate': 0.0,
+            'max_seq': 32,
+            'attention_block_size': block_size,
+            'lr': 0.001,
+            'beta_1': 0.9,
+            'beta_2': 0.98,
+            'epsilon': 1e-9,
+        }
+        transformer = create_transformer(32, 32, 32, 32, hparams)
+        transformer.create_weights()
+        if weights is not None:
+            transformer.set_weights(weights)
+
+        x = np.random.RandomState(0).randint(1, 32, [2, 2, 8])
+        # Left padding, the queries of the padding see no key
+        x[0, 0, :3] = 0
+        x[1, 0, :6] = 0
+        gradients, stats = transformer.compute_gradients((tf.constant(x[0]), tf.constant(x[1])))
+        return transformer.get_weights(), stats['loss'].numpy(), gradients
+
+    def test_left_padding(self):
+        weights, expected_loss, expected = self.loss_and_gradients(0)
+        for block_size in [4, 5]:
+            with self.subTest(block_size=block_size):
+                _, loss, gradients = self.loss_and_gradients(block_size, weights)
+                np.testing.assert_allclose(loss, expected_loss, rtol=1e-5)
+                for gradient, e in zip(gradients, expected):
+                    np.testing.assert_allclose(tf.convert_to_tensor(gradient).numpy(), tf.convert_to_tensor(e).numpy(),
+                                               rtol=1e-4, atol=1e-6)
+
+ATTENTION = {
+    'relative': {},
+    'dot': { 'encoder_attention': 'dot', 'decoder_attention': 'dot', 'cross_attention': 'dot' },
+    'blockwise': { 'attention_block_size': 4 },
+    'local': { 'encoder_attention': 'local', 'decoder_attention': 'local', 'local_window': 4 },
+}
+
+class TestGenerate(unittest.TestCase):
+    """
+    Generating with the key and value caches has to match recomputing the
+    whole sequence for every token.
+    """
+    def create_transformer(self, architecture, attention):
+        hparams = {
+            'architecture': architecture,
+            'num_layers': 2,
+            'd_model': 16,
+            'dff': 16,
+            'num_heads': 2,
+            'dropout_rate': 0.0,
+            'max_seq': 32,
+            'frame_size': 8,
+            'lr': 0.001,
+            'beta_1': 0.9,
+            'beta_2': 0.98,
+            'epsilon': 1e-9,
+            **ATTENTION[attention],
+        }
+        transformer = create_transformer(32, 32, 32, 32, hparams)
+        transformer.create_weights()
+        return transformer
+
+    def priors(self):
+        priors = np.random.RandomState(0).randint(1, 32, [2, 6])
+        # Left padding
+        priors[1, :2] = 0
+        return tf.constant(priors)
+
+    def assert_encoder_decoder(self, attention):
+        transformer = self.create_transformer('encoder_decoder', attention)
+        priors = self.priors()
+        tokens, _ = transformer.generate(priors)
+
+        enc_padding_mask, look_ahead_mask, dec_padding_mask = transformer.create_masks(priors, tokens[:, :-1])
+        logits, _ = transformer.call(priors, tokens[:, :-1], False, enc_padding_mask, look_ahead_mask, dec_padding_mask)
+        np.testing.assert_array_equal(tf.argmax(logits, axis=-1).numpy(), tokens[:, 1:].numpy())
+
+        enc_output = transformer.encoder(priors, False, enc_padding_mask)
+        caches = transformer.decoder.init_cache(enc_output, 8)
+        for i in range(8):
+            # The positions after i are not written yet
+            written = tokens[:, :8] * tf.cast(tf.range(8) <= i, tokens.dtype)
+            x, _, caches = transformer.decoder.step(tokens[:, i:i+1], caches, i, create_padding_mask(written),
+                                                    dec_padding_mask)
+            np.testing.assert_allclose(transformer.final_layer(x)[:, -1].numpy(), logits[:, i].numpy(),
+                                       rtol=1e-4, atol=1e-5, err_msg=f'position {i}')
+
+    def assert_decoder_only(self, attention):
+        transformer = self.create_transformer('decoder_only', attention)
+        priors = self.priors()
+        tokens, _ = transformer.generate(priors)
+
+        seq = tf.concat([priors, tokens[:, 1:]], axis=-1)[:, :-1]
+        logits = transformer.call(seq, False, create_padding_mask(seq))
+        np.testing.assert_array_equal(tf.argmax(logits[:, 5:], axis=-1).numpy(), tokens[:, 1:].numpy())
+
+        length = 6 + 8
+        x, caches = transformer.decoder.prefill(priors, length, create_padding_mask(priors))
+        np.testing.assert_allclose(transformer.final_layer(x).numpy(), logits[:, :6].numpy(), rtol=1e-4, atol=1e-5)
+        buffer = tf.pad(seq, [[0, 0], [0, 1]])
+        for pos in range(6, length - 1):
+            written = buffer * tf.cast(tf.range(length) <= pos, buffer.dtype)
+            x, caches = transformer.decoder.step(seq[:, pos:pos+1], caches, pos, create_padding_mask(written))
+            np.testing.assert_allclose(transformer.final_layer(x)[:, -1].numpy(), logits[:, pos].numpy(),
+                                       rtol=1e-4, atol=1e-5, err_msg=f'position {pos}')
+
+    def test_generate_encoder_decoder(self):
+        for attention in ATTENTION:
+            with self.subTest(attention=attention):
+                self.assert_encoder_decoder(attention)
+
+    def test_generate_decoder_only(self):
+        for attention in ATTENTION:
+            with self.subTest(attention=attention):
+                self.assert_decoder_only(attention)
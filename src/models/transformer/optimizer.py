@@ -10,6 +10,10 @@ class TransformerLRSchedule(tfk.optimizers.schedules.LearningRateSchedule):
         self.warmup_steps = warmup_steps
 
     def __call__(self, step):
+        # The optimizer passes its iterations, an integer. They count the
+        # steps whatever the frame length of the curriculum, so the warmup
+        # and decay are the same with and without one.
+        step = tf.cast(step, tf.float32)
         a = tf.math.rsqrt(step)
         b = step * (self.warmup_steps ** -1.5)
 
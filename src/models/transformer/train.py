@@ -8,111 +8,77 @@ import os
 from models.common.training import Trainer
 import matplotlib.pyplot as plt
 import data.process as pro
-from models.transformer.model import Transformer
+from models.transformer.model import create_transformer
 from models.transformer.generate import generate_from_model
+from models.transformer.curriculum import Curriculum
 import tensorflow_datasets as tfds
 from evolve.hparams import HParams
 from evolve.pool import Pool
 import util
 
-train_loss = tfk.metrics.Mean(name='train_loss')
-train_accuracy = tfk.metrics.SparseCategoricalAccuracy(name='train_accuracy')
-
 input_vocab_size  = 128+128+128+128
 target_vocab_size = 128+128+128+128
 
-# This runs at the start of every epoch
-def on_epoch_start(epoch, step, tsw):
-    train_loss.reset_states()
-    train_accuracy.reset_states()
-
-
-# This runs at the end of every epoch and is used to display metrics
-def on_epoch_complete(epoch, step, duration, tsw):
-
-    #display.clear_output(wait=True)
-    print(f"Epoch: {epoch}, Step: {step}, Loss: {train_loss.result()}, Accuracy: {train_accuracy.result()}, Duration: {duration:.3f}")
-
 def create_model(hp):
     print(hp)
-    return Transformer(input_vocab_size=input_vocab_size,
-                       target_vocab_size=target_vocab_size,
-                       pe_input=input_vocab_size,
-                       pe_target=target_vocab_size,
-                       hparams=hp)
+    transformer = create_transformer(input_vocab_size=input_vocab_size,
+                                     target_vocab_size=target_vocab_size,
+                                     pe_input=input_vocab_size,
+                                     pe_target=target_vocab_size,
+                                     hparams=hp)
+    transformer.create_weights()
+    return transformer
 
 def evaluate(dataset, hparams):
     def _eval(model):
         trainer = Trainer(dataset, hparams)
 
-        trainer.set_train_step(model.train_step)
-        trainer.on_epoch_start = on_epoch_start
-        trainer.on_step = on_step
-        trainer.on_epoch_complete = on_epoch_complete
-
+        trainer.set_model(model)
 
         stats = trainer.run()
         if stats is not None:
-            loss, _, _ = stats
-            return 1 / tf.reduce_mean(loss).numpy()
+            return 1 / stats['loss'].numpy()
         else:
             return 0
     return _eval
 
-def start(hparams):
-    gc.collect()
-
-    dataset = tf.data.Dataset.list_files('/home/big/datasets/maestro-v2.0.0/**/*.midi')
+def create_frames(hparams):
+    dataset = tf.data.Dataset.list_files(os.path.join(hparams['dataset_root'], '**/*.midi'))
 
-    dataset_single = pro.pipeline([
+    return pro.interleave(pro.pipeline([
         pro.midi(),
         pro.frame(hparams['frame_size']*2, hparams['frame_hop_len'], True),
         pro.unbatch(),
-    ])(dataset)
+    ]), hparams['cycle_length'] if 'cycle_length' in hparams else 1)(dataset)
+
+def create_dataset(hparams):
+    if 'num_parallel_calls' in hparams:
+        pro.set_num_parallel_calls(hparams['num_parallel_calls'])
 
     def _reshape(inp, tar):
         inp = tf.reshape(inp, [hparams['frame_size']])
         tar = tf.reshape(tar, [hparams['frame_size']])
         return inp, tar
 
-
-    dataset = pro.pipeline([
+    return pro.pipeline([
         pro.split(2),
         #pro.batch(2, True),
         # pro.dupe(),
         pro.map_transform(_reshape),
-        pro.cache(),
+        pro.cache_placement(hparams['cache'] if 'cache' in hparams else 'memory'),
         pro.shuffle(hparams['buffer_size']),
         pro.batch(hparams['batch_size'], True),
-        pro.prefetch(),
-    ])(dataset_single)
-
-
-    dataset_single = pro.shuffle(hparams['buffer_size']//4)(dataset_single)
+        pro.prefetch(hparams['prefetch'] if 'prefetch' in hparams else tf.data.experimental.AUTOTUNE),
+    ])(create_frames(hparams))
+
+def create_sampler(hparams, transformer):
+    """
+    Returns a function generating a sample with transformer and writing it to
+    a summary writer, in training or in the sample worker.
+    """
+    dataset_single = pro.shuffle(hparams['buffer_size']//4)(create_frames(hparams))
     dataset_single = dataset_single.as_numpy_iterator()
 
-    transformer = Transformer(input_vocab_size=input_vocab_size,
-                              target_vocab_size=target_vocab_size,
-                              pe_input=input_vocab_size,
-                              pe_target=target_vocab_size,
-                              hparams=hparams)
-
-    # pop_size = 10
-    # generations = 100
-    # mutation_rate = 0.2
-    # pool.populate(pop_size, 1)
-
-    # for generation in range(generations):
-    #     pool.evaluate(evaluate(dataset, hparams))
-    #     print(f"--- GENERATION: {generation} ---")
-    #     print("BEST:", pool.best, pool.fitness)
-    #     pool.select(pop_size)
-    #     pool.populate(pop_size, mutation_rate)
-    #
-
-
-    image_save_step = hparams['image_save_step'] if 'image_save_step' in hparams else 2000
-
     def generate_image(step, tsw):
         print("Generating sample...")
         encoded, seed = generate_from_model(hparams, transformer, dataset_single)
@@ -148,20 +114,54 @@ def start(hparams):
             tf.summary.image(f'image', image_conc, step=step)
         print("Complete.")
 
+    return generate_image
 
-    # This runs at every step in the training (for each batch in dataset)
-    def on_step(epoch, step, stats, tsw):
-        loss, tar_real, predictions = stats
-        train_loss(loss)
-        train_accuracy(tar_real, predictions)
-        if step % 100 == 0:
-            print(f"Epoch: {epoch}, Step: {step}, Loss: {train_loss.result()}, Accuracy: {train_accuracy.result()}")
-        if step % image_save_step == 0:
-            generate_image(step, tsw)
+def sampler(hparams):
+    """
+    Creates the transformer for the sample worker. Returns the objects to
+    restore from the training checkpoint and the sampling function.
+    """
+    transformer = create_model(hparams)
+    return { 'transformer': transformer }, create_sampler(hparams, transformer)
 
-        with tsw.as_default():
-            tf.summary.scalar('loss', train_loss.result(), step=step)
+def start(hparams):
+    gc.collect()
+
+    dataset = create_dataset(hparams)
+
+    transformer = create_transformer(input_vocab_size=input_vocab_size,
+                                     target_vocab_size=target_vocab_size,
+                                     pe_input=input_vocab_size,
+                                     pe_target=target_vocab_size,
+                                     hparams=hparams)
+    transformer.create_weights()
+
+    # pop_size = 10
+    # generations = 100
+    # mutation_rate = 0.2
+    # pool.populate(pop_size, 1)
 
+    # for generation in range(generations):
+    #     pool.evaluate(evaluate(dataset, hparams))
+    #     print(f"--- GENERATION: {generation} ---")
+    #     print("BEST:", pool.best, pool.fitness)
+    #     pool.select(pop_size)
+    #     pool.populate(pop_size, mutation_rate)
+    #
+
+
+    image_save_step = hparams['image_save_step'] if 'image_save_step' in hparams else 2000
+    sample_worker = hparams['sample_worker'] if 'sample_worker' in hparams else False
+    generate_image = None if sample_worker else create_sampler(hparams, transformer)
+
+    # This runs at every step in the training (for each batch in dataset),
+    # the loss and accuracy are logged by the trainer
+    def on_step(epoch, step, stats, tsw):
+        if step % image_save_step == 0:
+            if sample_worker:
+                trainer.request_samples(step)
+            else:
+                generate_image(step, tsw)
 
 
     trainer = Trainer(dataset, hparams)
@@ -173,10 +173,10 @@ def start(hparams):
 
     trainer.init_checkpoint(ckpt)
     trainer.init_tensorboard()
-    trainer.set_train_step(transformer.train_step)
-    trainer.on_epoch_start = on_epoch_start
+    trainer.set_model(transformer)
     trainer.on_step = on_step
-    trainer.on_epoch_complete = on_epoch_complete
+    if 'curriculum' in hparams and hparams['curriculum']:
+        trainer.set_curriculum(Curriculum(hparams['curriculum'], hparams['frame_size']))
 
     #generate_image(trainer.step.numpy(), trainer.train_summary_writer)
 
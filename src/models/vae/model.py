@@ -5,6 +5,8 @@ from tensorflow_probability import layers as tfpl
 from tensorflow_probability import distributions as tfd
 import tensorflow.keras as tfk
 import tensorflow.keras.layers as tfkl
+import models.common.precision as precision
+import models.common.distribute as distribute
 
 class VAE():
     def __init__(self, hparams):
@@ -14,21 +16,37 @@ class VAE():
 
         self.vae, self.encoder, self.decoder = self.create_vae()
         self.optimizer = tf.keras.optimizers.RMSprop(self.hparams['lr'])
+        self.train_optimizer = precision.loss_scale_optimizer(self.optimizer)
 
     @tf.function
     def train_step(self, x):
+        gradients, stats = self.compute_gradients(x)
+        self.apply_gradients(gradients)
+        return stats
+
+    def compute_gradients(self, x):
+        """
+        The gradients of the loss on x, in the same structure as
+        train_variables, and the stats returned by train_step.
+        """
         x, y_target = x
         with tf.GradientTape() as tape:
             y = self.vae(x, training=True)
 
             reg_loss = self.encoder.losses[0]
             loss = self.negloglik(y, y_target) + reg_loss
+            scaled_loss = precision.scale_loss(self.train_optimizer, distribute.replica_loss(loss))
 
-        gradients = tape.gradient(loss, self.vae.trainable_variables)
+        gradients = tape.gradient(scaled_loss, self.vae.trainable_variables)
+        gradients = precision.unscale_gradients(self.train_optimizer, gradients)
 
-        self.optimizer.apply_gradients(zip(gradients, self.vae.trainable_variables))
+        return gradients, {'loss': loss}
 
-        return loss
+    def apply_gradients(self, gradients):
+        self.train_optimizer.apply_gradients(zip(gradients, self.vae.trainable_variables))
+
+    def train_variables(self):
+        return self.vae.trainable_variables
 
     def create_vae(self):
         input_size = self.hparams['window_samples']
@@ -44,8 +62,10 @@ class VAE():
 
         o = tfkl.Flatten()(o)
 
-        o = tfkl.Dense(tfpl.IndependentNormal.params_size(self.hparams['latent_size']), activation=None)(o)
-        o = tfpl.IndependentNormal(self.hparams['latent_size'], activity_regularizer=tfpl.KLDivergenceRegularizer(self.prior, weight=2.0))(o)
+        # The distributions and the layers producing their parameters are
+        # float32 with mixed precision
+        o = tfkl.Dense(tfpl.IndependentNormal.params_size(self.hparams['latent_size']), activation=None, dtype='float32')(o)
+        o = tfpl.IndependentNormal(self.hparams['latent_size'], activity_regularizer=tfpl.KLDivergenceRegularizer(self.prior, weight=2.0), dtype='float32')(o)
 
         encoder = tfk.Model(inputs=i, outputs=o)
 
@@ -64,8 +84,8 @@ class VAE():
         o = tfkl.Conv1D(1, kernel_size=1, strides=1, padding='same')(o)
         o = tfkl.Flatten()(o)
 
-        o = tfkl.Dense(tfpl.IndependentNormal.params_size((self.hparams['window_samples'], 1)), activation='tanh')(o)
-        o = tfpl.IndependentNormal((self.hparams['window_samples'],1))(o)
+        o = tfkl.Dense(tfpl.IndependentNormal.params_size((self.hparams['window_samples'], 1)), activation='tanh', dtype='float32')(o)
+        o = tfpl.IndependentNormal((self.hparams['window_samples'],1), dtype='float32')(o)
 
         decoder = tfk.Model(inputs=i, outputs=o)
 
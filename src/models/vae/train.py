@@ -5,36 +5,35 @@ from data.maestro import maestro_from_files
 from models.vae.model import VAE
 import tensorflow_datasets as tfds
 
-loss_avg = tf.keras.metrics.Mean()
+def create_dataset(hparams):
+    if 'num_parallel_calls' in hparams:
+        pro.set_num_parallel_calls(hparams['num_parallel_calls'])
 
+    # The compiled train step needs every batch to have the same shape
+    drop_remainder = hparams['xla'] if 'xla' in hparams else False
 
-def on_epoch_start(epoch, step, tsw):
-    loss_avg.reset_states()
-
-def on_step(epoch, step, loss, tsw):
-    loss_avg(loss)
-    if step % 100 == 0:
-        print(f"Epoch: {epoch}, Step: {step}, Loss: {loss_avg.result()}")
-    with tsw.as_default():
-        tf.summary.scalar('loss', loss_avg.result(), step=step)
-
-def start(hparams):
     # Load nsynth dataset
     # dataset = tfds.load('nsynth/gansynth_subset', split='train', shuffle_files=True)
     dataset = tf.data.Dataset.list_files('/home/big/datasets/maestro-v2.0.0/**/*.wav')
-    dataset = pro.pipeline([
-        pro.wav(),
-        # pro.resample(16000, hparams['sample_rate'], tf.float32),
-        pro.normalize(),
-        pro.frame(hparams['window_samples'], hparams['window_samples']),
-        pro.unbatch(),
-        pro.set_channels(1),
+    return pro.pipeline([
+        pro.interleave(pro.pipeline([
+            pro.wav(),
+            # pro.resample(16000, hparams['sample_rate'], tf.float32),
+            pro.normalize(),
+            pro.frame(hparams['window_samples'], hparams['window_samples']),
+            pro.unbatch(),
+        ]), hparams['cycle_length'] if 'cycle_length' in hparams else 1),
+        pro.reshape([-1, 1]),
         pro.dupe(),
+        pro.cache_placement(hparams['cache'] if 'cache' in hparams else 'none'),
         pro.shuffle(hparams['buffer_size']),
-        pro.batch(hparams['batch_size']),
-        pro.prefetch()
+        pro.batch(hparams['batch_size'], drop_remainder),
+        pro.prefetch(hparams['prefetch'] if 'prefetch' in hparams else tf.data.experimental.AUTOTUNE),
     ])(dataset)
 
+def start(hparams):
+    dataset = create_dataset(hparams)
+
     vae = VAE(hparams)
 
     vae.vae.summary()
@@ -48,10 +47,7 @@ def start(hparams):
         vae=vae.vae,
     )
 
-    trainer.on_epoch_start = on_epoch_start
-    trainer.on_step = on_step
-
     trainer.init_tensorboard()
     trainer.init_checkpoint(ckpt)
-    trainer.set_train_step(vae.train_step)
+    trainer.set_model(vae)
     trainer.run()
@@ -0,0 +1,88 @@
+import os
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+import tensorflow as tf
+import argparse
+import importlib
+import time
+from models.common.precision import set_precision_policy
+from models.common.training import read_sample_request
+from util import load_hparams, load_hparams_overlay, parse_train_args
+
+# Some compatability options for some graphics cards
+from tensorflow.compat.v1 import ConfigProto
+from tensorflow.compat.v1 import InteractiveSession
+
+config = ConfigProto()
+config.gpu_options.allow_growth = True
+session = InteractiveSession(config=config)
+
+def run(train, directory, poll_interval, once=False):
+    """
+    Waits for sample requests from the trainer in the checkpoint directory,
+    and for each generates samples from the newest checkpoint with the
+    sampler of the model, into the tensorboard log of the training run.
+    """
+    print(f"Waiting for sample requests in {directory}")
+    handled = None
+    restored = None
+    sample = None
+    log_dir = None
+    while True:
+        request = read_sample_request(directory)
+        path = tf.train.latest_checkpoint(directory)
+        if request is None or request['time'] == handled or path is None:
+            time.sleep(poll_interval)
+            continue
+
+        if sample is None:
+            # The model is created from the hparams the trainer used, so
+            # that it matches the checkpoint
+            set_precision_policy(request['hparams'])
+            step = tf.Variable(0)
+            objects, sample = train.sampler(request['hparams'])
+            ckpt = tf.train.Checkpoint(step=step, **objects)
+
+        if path != restored:
+            ckpt.restore(path).expect_partial()
+            restored = path
+
+        # The trainer can request samples for a step before it has saved the
+        # checkpoint of that step
+        if step.numpy() < request['step']:
+            time.sleep(poll_interval)
+            continue
+
+        if request['log_dir'] != log_dir:
+            log_dir = request['log_dir']
+            tsw = tf.summary.create_file_writer(log_dir)
+
+        handled = request['time']
+        print(f"Sampling from {path} at step {step.numpy()}, requested at step {request['step']}")
+        start = time.time()
+        sample(int(step.numpy()), tsw)
+        tsw.flush()
+        print(f"Sampling done in {time.time() - start:.3f} seconds")
+
+        if once:
+            return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate samples for a model while it is training')
+
+    parser.add_argument('--model', metavar='N', required=True, help='The model being trained', type=str, nargs='?')
+    parser.add_argument('--poll_interval', metavar='S', help='Seconds between checks for sample requests', type=float, nargs='?', default=5)
+    parser.add_argument('--once', help='Exit after the first sample request', action='store_true')
+
+    args, unknownargs = parser.parse_known_args()
+
+    train = importlib.import_module(f'models.{args.model}.train')
+    if not hasattr(train, 'sampler'):
+        raise Exception(f"No sampler for model '{args.model}'.")
+
+    # Only used to find the checkpoint directory, the same args as for
+    # train.py should be given
+    hparams = load_hparams(f'hparams/{args.model}.yml')
+    hparams = load_hparams_overlay(f'hparams/{args.model}.tuned.yml', hparams)
+    hparams = parse_train_args(unknownargs, hparams)
+
+    run(train, os.path.join(hparams['save_dir'], 'ckpts', hparams['name']), args.poll_interval, args.once)
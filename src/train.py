@@ -5,16 +5,14 @@ import argparse
 import subprocess
 import os
 import importlib
-from util import load_hparams, parse_train_args
+from models.common.precision import set_precision_policy
+from models.common.distribute import create_strategy
+from util import load_hparams, load_hparams_overlay, parse_train_args
 
 # Some compatability options for some graphics cards
 from tensorflow.compat.v1 import ConfigProto
 from tensorflow.compat.v1 import InteractiveSession
 
-config = ConfigProto()
-config.gpu_options.allow_growth = True
-session = InteractiveSession(config=config)
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start training a model')
 
@@ -26,6 +24,21 @@ if __name__ == '__main__':
 
     # Load hyperparams from yaml file
     hparams = load_hparams(f'hparams/{args.model}.yml')
+    hparams = load_hparams_overlay(f'hparams/{args.model}.tuned.yml', hparams)
     hparams = parse_train_args(unknownargs, hparams)
 
-    train.start(hparams)
+    # Has to be created before tensorflow initializes the devices, which
+    # creating the session does
+    strategy = create_strategy(hparams)
+
+    config = ConfigProto()
+    config.gpu_options.allow_growth = True
+    session = InteractiveSession(config=config)
+
+    # Has to be set before the models are created
+    set_precision_policy(hparams)
+
+    # The models, optimizers and the rest of the training state are
+    # created in the scope, to be mirrored over the replicas
+    with strategy.scope():
+        train.start(hparams)
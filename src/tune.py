@@ -0,0 +1,92 @@
+import os
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+import argparse
+import importlib
+import time
+import tensorflow as tf
+from evolve.pool import Pool
+from util import load_hparams, load_hparams_overlay, save_hparams, run_isolated, peak_rss_mb
+
+# The input pipeline settings that are searched, see create_dataset in
+# models/<model>/train.py for how they are used. -1 means AUTOTUNE. The
+# cache is left as in the hparams, it only pays off from the second pass over
+# the dataset, which a measurement doesn't get to.
+search_space = {
+    'num_parallel_calls': {'type': 'choice', 'values': [1, 2, 4, 8, -1]},
+    'cycle_length': {'type': 'choice', 'values': [1, 2, 4, 8]},
+    'buffer_size': {'type': 'choice', 'values': [500, 1000, 5000, 10000]},
+    'prefetch': {'type': 'choice', 'values': [1, 2, 4, -1]},
+}
+
+def measure_pipeline(model, hparams, seconds):
+    """
+    Runs the training input pipeline of model for the given number of seconds
+    and returns the number of examples per second and the peak RSS in MB.
+    Meant to be run through run_isolated, so that every measurement starts
+    from a fresh process.
+    """
+    train = importlib.import_module(f'models.{model}.train')
+
+    dataset = train.create_dataset(hparams).repeat()
+    iterator = iter(dataset)
+
+    # The first element includes building the pipeline and filling buffers
+    next(iterator)
+
+    examples = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        batch = next(iterator)
+        examples += tf.nest.flatten(batch)[0].shape[0]
+
+    return examples / (time.time() - start), peak_rss_mb()
+
+def tune(model, hparams, seconds, population, generations, max_rss=None):
+    # Without a store every measurement of the GAN would compute the stats
+    # of the whole dataset again, and overwrite gan_stats.npz
+    if model == 'gan' and not ('melspec_store' in hparams and hparams['melspec_store']):
+        raise Exception("No melspec_store to tune the GAN input pipeline on, set one in hparams/gan.yml. It is built once, before the first measurement.")
+
+    results = {}
+
+    def fitness(settings):
+        key = tuple(sorted(settings.items()))
+        if key not in results:
+            print(f"Measuring {settings}...")
+            results[key] = run_isolated(measure_pipeline, model, { **hparams, **settings }, seconds)
+            print(f"Examples/sec: {results[key][0]:.1f}, Peak RSS: {results[key][1]:.0f} MB")
+
+        examples_per_sec, rss = results[key]
+        if max_rss is not None and rss > max_rss:
+            return 0
+        return examples_per_sec
+
+    pool = Pool(lambda hp: hp, search_space).populate(population, 1)
+    for generation in range(generations):
+        if generation > 0:
+            pool.select(population).populate(population, 0.3)
+        pool.evaluate(fitness)
+        print(f"--- GENERATION: {generation} ---")
+        print("BEST:", pool.best[0], pool.fitness[0][0])
+
+    return pool.best[0]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the input pipeline settings of a model')
+
+    parser.add_argument('--model', metavar='N', required=True, help='The model whose input pipeline to tune', type=str, nargs='?')
+    parser.add_argument('--seconds', metavar='N', help='How long to measure each setting', type=float, default=20)
+    parser.add_argument('--population', metavar='N', help='Number of settings measured per generation', type=int, default=6)
+    parser.add_argument('--generations', metavar='N', help='Number of generations to search', type=int, default=3)
+    parser.add_argument('--max_rss', metavar='MB', help='Reject settings with a higher peak RSS', type=float, default=None)
+
+    args = parser.parse_args()
+
+    overlay = f'hparams/{args.model}.tuned.yml'
+    hparams = load_hparams(f'hparams/{args.model}.yml')
+    hparams = load_hparams_overlay(overlay, hparams)
+
+    best = tune(args.model, hparams, args.seconds, args.population, args.generations, args.max_rss)
+
+    save_hparams(overlay, best)
+    print(f"Saved {best} to {overlay}")
@@ -3,6 +3,10 @@ import matplotlib.pyplot as plt
 import yaml
 import argparse
 import io
+import os
+import resource
+import multiprocessing
+from queue import Empty
 
 def load_hparams(path):
     with open(path, 'r') as stream:
@@ -14,6 +18,49 @@ def load_hparams(path):
     return hparams
 
 
+def load_hparams_overlay(path, hparams):
+    """
+    Merges the hparams in the yaml file at path, if it exists, over hparams.
+    Used for the settings written by tune.py.
+    """
+    if not os.path.exists(path):
+        return hparams
+
+    print(f"Using hparams overlay {path}")
+    return { **hparams, **load_hparams(path) }
+
+def save_hparams(path, hparams):
+    with open(path, 'w') as stream:
+        yaml.safe_dump({'hparams': hparams}, stream, default_flow_style=False)
+
+def _run_isolated(queue, fn, args):
+    queue.put(fn(*args))
+
+def run_isolated(fn, *args):
+    """
+    Runs fn(*args) in a fresh python process and returns its result. Useful
+    for measurements, like peak memory, that should not be affected by what
+    the current process has done before. fn has to be picklable, e.g. a
+    module level function.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_isolated, args=(queue, fn, args))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                raise Exception(f"Isolated process exited with code {process.exitcode}")
+    process.join()
+    return result
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
 def parse_train_args(args, hparams):
     parser = argparse.ArgumentParser(description='Start training of the model')
     parser.add_argument('--save_dir', metavar='PATH', help='Set the save directory for images and checkpoints', type=str, nargs='?', default=hparams['save_dir'])